@@ -5,26 +5,40 @@ import dash_html_components as html
 import dash_core_components as dcc
 from dash.dependencies import Input, Output, State, ClientsideFunction
 import plotly.graph_objects as go
-from skimage import data, img_as_ubyte, segmentation, measure
-from dash_canvas.utils import array_to_data_url
+from skimage import data, segmentation
 from dash import callback_context
 from plotly_common import plot_common
 from plotly_common import image_utils
 import numpy as np
-from nilearn import image
-import nibabel as nib
 import plotly.express as px
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from skimage import segmentation, color
 from skimage.future import graph
 from plotly_common import shape_utils
-from sys import exit
-import io
-import base64
-import skimage
+from plotly_common.label_index import LabelIndex
+from plotly_common.label_set import LabelSet
+from plotly_common.superpixel_stats import SuperpixelStats
+from plotly_common.shape_cache import SliceShapeCache
+from plotly_common.slice_cache import SliceCache
+from plotly_common.slice_labels import SliceLabels
+from plotly_common import array_cache
+from plotly_common import nifti_utils
+from plotly_common import slic_utils
+from plotly_common import mesh_utils
+from plotly_common import png_utils
+from plotly_common import rag_utils
+from plotly_common.case_registry import CaseRegistry
+from plotly_common.job_queue import JobQueue
+from plotly_common.session_store import SessionStore, new_session_id
 import time
 import os
+import threading
+import flask
+import uuid
+import glob
+from urllib.parse import parse_qs, urlencode
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import Session
 from database.config import get_db
 from database.user_crud import create_user, get_user_by_email
@@ -43,6 +57,9 @@ server = app.server
 
 
 Base.metadata.create_all(bind=engine)
+# the app is imported before the gunicorn workers are forked (see run_app.sh),
+# so the connections opened here are closed for each worker to open its own
+engine.dispose()
 
 
 
@@ -61,10 +78,96 @@ NUM_DIMS_DISPLAYED = 2  # top and side
 INDICATOR_COLOR = "DarkOrange"
 DISPLAY_BG_COLOR = "white"
 
-# A string, if length non-zero, saves superpixels to this file and then exits
-SAVE_SUPERPIXEL = os.environ.get("SAVE_SUPERPIXEL", default="")
-# A string, if length non-zero, loads superpixels from this file
+# A string, if length non-zero, superpixels of the default case not found in
+# the superpixel cache are loaded from this file (written by np.savez) instead
+# of being computed
 LOAD_SUPERPIXEL = os.environ.get("LOAD_SUPERPIXEL", default="")
+# The directory where the computed superpixels are cached
+SUPERPIXEL_CACHE_DIR = os.environ.get(
+    "SUPERPIXEL_CACHE_DIR", default=os.path.join("cache", "superpixels")
+)
+# The directory where the volumes of the cases are cached, normalized, as .npy
+# files that all the server processes map into memory
+VOLUME_CACHE_DIR = os.environ.get(
+    "VOLUME_CACHE_DIR", default=os.path.join("cache", "volumes")
+)
+# The directory where the encoded slices of the cases are cached
+SLICE_CACHE_DIR = os.environ.get(
+    "SLICE_CACHE_DIR", default=os.path.join("cache", "slices")
+)
+# The directory where the cases whose caches have all been filled are recorded
+PRECOMPUTE_DIR = os.environ.get(
+    "PRECOMPUTE_DIR", default=os.path.join("cache", "precomputed")
+)
+# The number of processes filling the caches of cases in the background
+PRECOMPUTE_WORKERS = int(os.environ.get("PRECOMPUTE_WORKERS", default="1"))
+# The number of seconds after which a case whose preparation failed is
+# prepared again (the failure may have been transient, e.g. a lack of memory)
+PRECOMPUTE_RETRY_AFTER = int(os.environ.get("PRECOMPUTE_RETRY_AFTER", default="600"))
+# How often in milliseconds the page of a case being prepared checks on it
+PRECOMPUTE_POLL_INTERVAL = 1000
+# The parameters of the SLIC partitioning into superpixels
+SLIC_COMPACTNESS = 0.1
+SLIC_N_SEGMENTS = 300
+# The step size of the marching cubes computing the 3D meshes
+MESH_STEP_SIZE = 3
+# If greater than 0 (and pyfqmr is installed), the mesh of the brain is
+# simplified to about this many faces. Without pyfqmr it is 0, so the meshes
+# cached are keyed by the number of faces they really were simplified to
+BRAIN_MESH_FACES = mesh_utils.decimation_target(
+    int(os.environ.get("BRAIN_MESH_FACES", default="0"))
+)
+# If greater than 1, the volume is partitioned in this many slabs in parallel
+# processes (see slic_utils.chunked_slic)
+SLIC_N_CHUNKS = int(os.environ.get("SLIC_N_CHUNKS", default="1"))
+# Growing the selection adds the neighbouring segments whose mean intensity is
+# within this much of the mean intensity of the selection
+GROW_TOLERANCE = float(os.environ.get("GROW_TOLERANCE", default="10"))
+# The coarser levels of superpixels that can be selected, as fractions of the
+# number of superpixels, each obtained by merging the superpixels of the finer
+# levels (see rag_utils.rag_hierarchy)
+SUPERPIXEL_LEVEL_FRACTIONS = [
+    float(f)
+    for f in os.environ.get("SUPERPIXEL_LEVEL_FRACTIONS", default="0.5,0.2").split(",")
+    if len(f) > 0
+]
+# The volumes of the cases that can be annotated, the ID of a case is the name
+# of its file without the .nii or .nii.gz extension
+CASES_GLOB = os.environ.get(
+    "CASES_GLOB", default=os.path.join("assets", "*_flair.nii*")
+)
+# The case shown when none is given in the URL (?case=<ID>), loaded at startup
+DEFAULT_CASE = os.environ.get("DEFAULT_CASE", default="BraTS19_2013_10_1_flair")
+# The number of cases kept loaded, with their superpixels and encoded slices
+CASE_CACHE_SIZE = int(os.environ.get("CASE_CACHE_SIZE", default="4"))
+# The parameters of the SLIC partitioning, which identify its results in the
+# superpixel cache
+slic_params = dict(compactness=SLIC_COMPACTNESS, n_segments=SLIC_N_SEGMENTS)
+if SLIC_N_CHUNKS > 1:
+    # the partitioning in slabs gives different superpixels
+    slic_params["n_chunks"] = SLIC_N_CHUNKS
+# The number of encoded image slices kept in memory for each case
+SLICE_CACHE_SIZE = int(os.environ.get("SLICE_CACHE_SIZE", default="1024"))
+# How long in seconds browsers may use a served slice without revalidating it
+SLICE_MAX_AGE = int(os.environ.get("SLICE_MAX_AGE", default="3600"))
+# The number of annotation sessions (the shapes drawn by a client on a case
+# and what was derived from them) kept in memory
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", default="256"))
+# The directory where the annotation sessions are also stored, so that they
+# survive restarts and are shared by the server processes. If empty, each
+# process keeps its own sessions, which is only right with a single process
+SESSION_DIR = os.environ.get("SESSION_DIR", default=os.path.join("cache", "sessions"))
+# The number of seconds after which the stored session of a client that
+# stopped drawing is removed from SESSION_DIR (the client sends its shapes
+# again if it comes back)
+SESSION_MAX_AGE = int(os.environ.get("SESSION_MAX_AGE", default="86400"))
+# The zlib level (0 to 9) of the PNG encoding of the overlays: the lower, the
+# faster to encode, the higher, the smaller
+OVERLAY_PNG_LEVEL = int(os.environ.get("OVERLAY_PNG_LEVEL", default="6"))
+# The version of the encoding of the slices, part of the keys of the encoded
+# slices on disk: increment it when an encode function changes, so that the
+# slices encoded before are not served anymore
+SLICE_ENCODING_VERSION = 2
 # If not "0", debugging mode is on.
 DEBUG = os.environ.get("DEBUG", default="0") != "0"
 
@@ -77,35 +180,39 @@ def PRINT(*vargs):
 
 #segmenta a imagem fornecida usando SLIC, visualiza os superpixels e mantem
 #apenas aqueles com intensidade media acima de um certo limerar p remover o fundo
-#retorna uma imagem com as bordas dos segmentos e a matriz de rotulos de segumento
-def make_seg_image(img):
-    """ Segment the image, then find the boundaries, then return an array that
-    is clear (alpha=0) where there are no boundaries. """
-    segb = np.zeros_like(img).astype("uint8")
-    seg = segmentation.slic(
-        img, start_label=1, multichannel=False, compactness=0.1, n_segments=300
-    )
+#retorna a matriz de rotulos de segmento
+def make_seg_image(
+    img,
+    compactness=SLIC_COMPACTNESS,
+    n_segments=SLIC_N_SEGMENTS,
+    n_chunks=SLIC_N_CHUNKS,
+):
+    """ Segment the image and return the labels of the segments, 0 being the
+    background. The boundaries shown are computed from the labels, see
+    Case. """
+    if n_chunks > 1:
+        seg = slic_utils.chunked_slic(
+            img, n_segments, n_chunks, multichannel=False, compactness=compactness,
+        )
+    else:
+        seg = segmentation.slic(
+            img,
+            start_label=1,
+            multichannel=False,
+            compactness=compactness,
+            n_segments=n_segments,
+        )
 
     # Visualizar superpixels para a visualização superior
     # visualize_superpixels(img, seg, view_type="Side View")
 
     # Somente mantenha superpixels com uma intensidade média maior que o limiar
     # para remover superpixels do fundo
-    superpx_avg = (
-        np.histogram(
-            seg.astype(np.float), bins=np.arange(0, 310), weights=img.astype(np.float)
-        )[0]
-        / np.histogram(seg.astype(np.float), bins=np.arange(0, 310))[0]
-        > 10
-    )
+    superpx_avg = SuperpixelStats(seg, img).mean > 10
     mask_brain = superpx_avg[seg]
     seg[np.logical_not(mask_brain)] = 0
     seg, _, _ = segmentation.relabel_sequential(seg)
-    segb = segmentation.find_boundaries(seg).astype("uint8")
-    segl = image_utils.label_to_colors(
-        segb, colormap=["#000000", "#E48F72"], alpha=[0, 128], color_class_offset=0
-    ) 
-    return (segl, seg)
+    return seg
 
 
 # def visualize_superpixels(img, segments_slic, view_type="Side View"):
@@ -179,79 +286,629 @@ def make_default_figure(
     return fig
 
 
-img = image.load_img("assets//BraTS19_2013_10_1_flair.nii")
-img = img.get_fdata().transpose(2, 0, 1)[::-1].astype("float")
+# the source of a found segments slice containing no colored pixels
+BLANK_SLICE = ""
+# the render ID of the found segments before anything is drawn
+INITIAL_RENDER_ID = "0"
+
+SLICE_ROUTE = "slices/<case_id>/<volume>/<int:view>/<int:index>.png"
+# the volume whose slices are the found segments, rendered from the labels
+# passed in the URL
+FOUND_VOLUME = "found"
+
+
+def slice_url(case_id, volume, view, index):
+    return app.get_relative_path(
+        "/slices/%s/%s/%d/%d.png" % (case_id, volume, view, index)
+    )
+
+
+def found_slice_url(case_id, view, index, labels):
+    """ The URL of a slice of the found segments, given the labels of the found
+    segments the slice contains. """
+    return (
+        slice_url(case_id, FOUND_VOLUME, view, index)
+        + "?labels="
+        + ",".join(str(l) for l in labels)
+    )
+
+
+def request_labels():
+    """ The sorted tuple of the labels passed as ?labels=l1,l2,... in the
+    request. Aborts with 400 if they are not integers. """
+    try:
+        labels = flask.request.args.get("labels", default="")
+        return tuple(sorted(set(int(l) for l in labels.split(",") if len(l) > 0)))
+    except ValueError:
+        flask.abort(400)
+
+
+@server.route(app.config.routes_pathname_prefix + SLICE_ROUTE)
+def serve_slice(case_id, volume, view, index):
+    args = ()
+    if volume == FOUND_VOLUME:
+        # the found slices are composed from the masks of the labels of the
+        # slice, see Case.encode_found_slice
+        args = (view, index, request_labels())
+    try:
+        png, etag = cases.get(case_id).slice_cache.get(volume, view, index, *args)
+    except (KeyError, IndexError):
+        flask.abort(404)
+    response = flask.Response(png, mimetype="image/png")
+    # the contents of a slice URL only change when the volume changes, so the
+    # browser can keep it and revalidate it using the ETag
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = SLICE_MAX_AGE
+    return response.make_conditional(flask.request)
+
+
+DOWNLOAD_ROUTE = "downloads/<case_id>/<name>.nii.gz"
+
+
+def download_url(case_id, name, labels=None):
+    """ The URL of the brain volume (name "brain") or of the found segments
+    with the labels, a LabelSet (name "found"), as a .nii.gz file. """
+    url = app.get_relative_path("/downloads/%s/%s.nii.gz" % (case_id, name))
+    if labels is not None:
+        url += "?labels=" + labels.encode()
+    return url
+
+
+@server.route(app.config.routes_pathname_prefix + DOWNLOAD_ROUTE)
+def serve_download(case_id, name):
+    """ Streams the volume as a gzipped NIfTI file, a slice at a time, in the
+    orientation of the slices of the first view stacked along the last
+    axis. """
+    try:
+        case = cases.get(case_id)
+    except KeyError:
+        flask.abort(404)
+    n = case.img.shape[0]
+    if name == "brain":
+        shape = case.img.shape[1:] + (n,)
+        chunks = (case.img[i].T for i in range(n))
+    elif name == "found":
+        try:
+            labels = LabelSet.decode(
+                case.seg_index.n_labels, flask.request.args.get("labels", default="")
+            )
+        except ValueError:
+            flask.abort(400)
+        # the found segments are colored a slice at a time, for each channel
+        # in turn since the channels are the slowest varying axis of the file,
+        # by looking up the labels in a table of their colors
+        label_colors = FOUND_SEGS_LUT[labels.mask().astype("uint8")]
+        shape = case.img.shape[1:] + (n, 4)
+        chunks = (label_colors[case.seg[i], c].T for c in range(4) for i in range(n))
+    else:
+        flask.abort(404)
+    response = flask.Response(
+        nifti_utils.stream_nifti_gz(shape, np.uint8, chunks),
+        mimetype="application/gzip",
+    )
+    response.headers["Content-Disposition"] = "attachment; filename=%s_%s.nii.gz" % (
+        case_id,
+        name,
+    )
+    return response
+
+
+def case_paths():
+    """ Returns a dict mapping the ID of each case to the path of its volume. """
+    paths = dict()
+    for path in glob.glob(CASES_GLOB):
+        name = os.path.basename(path)
+        for ext in [".nii.gz", ".nii"]:
+            if name.endswith(ext):
+                paths[name[: -len(ext)]] = path
+                break
+    return paths
+
+
+#inicializa as fatias de segmentos encontrados como vazias (sem pixels coloridos)
+def make_empty_found_segments(shape):
+    """ fstc_slices is initialized to empty image sources (nothing is drawn),
+    so no blank slices need to be encoded """
+    return [[BLANK_SLICE for _ in range(shape[j])] for j in range(NUM_DIMS_DISPLAYED)]
+
 
-img = img_as_ubyte((img - img.min()) / (img.max() - img.min()))
+def load_superpixel_file(path):
+    """ Loads the labels seg from a file written by np.savez, possibly gzipped
+    (only seg is read, the other arrays of the file are not decompressed). """
+    if path.endswith(".gz"):
+        import gzip
+
+        with gzip.open(path) as fd:
+            return np.load(fd)["seg"]
+    return np.load(path)["seg"]
+
+
+def seg_level_volume(level):
+    """ The name of the slice cache volume showing the segments of a level. """
+    return "seg" if level == 0 else "seg-%d" % (level,)
 
 
-#inicializa um tensor de segmentos encontrados como zero (sem pixels coloridos) e converte em uma imagem colorida clara
-def make_empty_found_segments():
-    """ fstc_slices is initialized to a bunch of images containing nothing (clear pixels) """
-    found_segs_tensor = np.zeros_like(img)
-    # convert to a colored image (but it will just be colored "clear")
-    fst_colored = image_utils.label_to_colors(
-        found_segs_tensor,
-        colormap=["#000000", "#8A2BE2"],
+def encode_boundary_slice(boundary_slice):
+    # the overlays only have 2 colors, so they are encoded as 1 bit palette
+    # PNGs rather than RGBA
+    return png_utils.palette_png_bytes(
+        boundary_slice,
+        ["#000000", "#E48F72"],
         alpha=[0, 128],
-        color_class_offset=0,
+        compresslevel=OVERLAY_PNG_LEVEL,
     )
-    fstc_slices = [
-        [
-            array_to_data_url(np.moveaxis(fst_colored, 0, j)[i])
-            for i in range(np.moveaxis(fst_colored, 0, j).shape[0])
+
+
+class Case:
+    """ A volume to annotate and everything derived from it: its superpixels
+    (with their index, statistics, adjacency graph, levels and meshes) and the
+    cache of its encoded slices. """
+
+    def __init__(self, case_id, path):
+        self.case_id = case_id
+        # the volume is normalized straight into a uint8 array, without a float
+        # copy of the whole image, the first time the file is seen. Like all
+        # the arrays below that are loaded from a cache, it is memory-mapped
+        # read-only, so the server processes share its pages
+        stat = os.stat(path)
+        (img,) = array_cache.load_or_compute_arrays(
+            VOLUME_CACHE_DIR,
+            array_cache.array_cache_key(
+                path=os.path.abspath(path), size=stat.st_size, mtime=stat.st_mtime
+            ),
+            ["img"],
+            lambda: (nifti_utils.load_nifti_ubyte(path),),
+        )
+        self.img = img
+
+        def compute_superpixels():
+            # only the labels are computed, the boundaries shown are computed
+            # from them below like those of the coarser levels
+            if len(LOAD_SUPERPIXEL) > 0 and case_id == DEFAULT_CASE:
+                # load partitioned image (to save time)
+                return (load_superpixel_file(LOAD_SUPERPIXEL),)
+            # partition image
+            return (make_seg_image(img),)
+
+        # the superpixels are cached by the contents of the image and the
+        # parameters of the partitioning, so they are only computed the first
+        # time a volume is seen
+        (seg,) = array_cache.load_or_compute_arrays(
+            SUPERPIXEL_CACHE_DIR,
+            array_cache.array_cache_key(img, **slic_params),
+            ["seg"],
+            compute_superpixels,
+        )
+        self.seg = seg
+        # maps each superpixel label to its voxels so that selecting segments
+        # only touches the selected voxels
+        seg_key = array_cache.array_cache_key(seg)
+
+        def compute_index():
+            index = LabelIndex(seg)
+            return (index.offsets, index.flat_indices)
+
+        self.seg_index = LabelIndex.from_arrays(
+            seg.shape,
+            *array_cache.load_or_compute_arrays(
+                SUPERPIXEL_CACHE_DIR,
+                seg_key,
+                ["index-offsets", "index-flat-indices"],
+                compute_index,
+            ),
+        )
+        # the voxel count, mean intensity and bounding box of each segment,
+        # computed in one pass so that the features below don't scan the
+        # volume again
+        self.seg_stats = SuperpixelStats(seg, img, n_labels=self.seg_index.n_labels)
+        # the adjacency of the segments and their mean intensities, to grow a
+        # selection to the similar neighbouring segments
+        self.seg_rag = rag_utils.superpixel_rag(seg, self.seg_stats)
+        # the coarser levels of segments merge similar neighbouring segments. A
+        # level maps each segment to the one representing its region, so
+        # switching levels only looks the regions up
+        self.seg_levels = rag_utils.rag_hierarchy(
+            self.seg_rag,
+            self.seg_index.n_labels,
+            [
+                max(1, int(round(f * self.seg_rag.number_of_nodes())))
+                for f in SUPERPIXEL_LEVEL_FRACTIONS
+            ],
+        )
+        # the meshes of all the segments, in the orientation of the 3D view,
+        # are computed once (and cached on disk) so showing a selection in 3D
+        # only concatenates the meshes of the selected segments
+        seg_mesh_params = dict(step_size=MESH_STEP_SIZE, transpose=(1, 2, 0), flip=(2,))
+        self.seg_meshes = mesh_utils.PackedMeshes(
+            *array_cache.load_or_compute_arrays(
+                SUPERPIXEL_CACHE_DIR,
+                array_cache.array_cache_key(seg, **seg_mesh_params),
+                ["mesh-verts", "mesh-faces", "mesh-vert-offsets", "mesh-face-offsets"],
+                lambda: mesh_utils.pack_label_meshes(
+                    mesh_utils.LabelMeshCache(
+                        self.seg_index, stats=self.seg_stats, **seg_mesh_params
+                    ),
+                    self.seg_index.n_labels,
+                ),
+            )
+        )
+        # PNG encoded slices of the volumes, served by serve_slice. The slices
+        # are encoded when the browser first requests them
+        self.slice_cache = SliceCache(maxsize=SLICE_CACHE_SIZE)
+        # (and written to the disk cache, see precompute_case)
+        self.add_cached_volume("img", img)
+        # the boundaries of the segments (level 0, the identity) and of the
+        # regions of the coarser levels
+        for k in range(len(self.seg_levels)):
+            level = self.seg_levels[k]
+            (boundaries,) = array_cache.load_or_compute_arrays(
+                SUPERPIXEL_CACHE_DIR,
+                array_cache.array_cache_key(level, seg=seg_key),
+                ["boundaries"],
+                lambda: (segmentation.find_boundaries(level[seg]).astype("uint8"),),
+            )
+            self.add_cached_volume(
+                seg_level_volume(k), boundaries, encode=encode_boundary_slice
+            )
+        # the labels appearing in each slice, and the masks of the labels of
+        # the slices drawn, so that the found segments are rendered from the
+        # labels without scanning the volume or the slices
+        self.seg_slice_labels = SliceLabels(
+            seg,
+            n_labels=self.seg_index.n_labels,
+            views=range(NUM_DIMS_DISPLAYED),
+            maxsize=SLICE_CACHE_SIZE,
+        )
+        self.slice_cache.add_volume(FOUND_VOLUME, seg, encode=self.encode_found_slice)
+
+        self._brain_mesh_trace = None
+        self._brain_mesh_lock = threading.Lock()
+
+    def add_cached_volume(self, name, volume, encode=plot_common.array_to_png_bytes):
+        """ Adds the volume to the slice cache, with its encoded slices stored
+        in a directory of SLICE_CACHE_DIR named after its contents. """
+        cache_dir = os.path.join(
+            SLICE_CACHE_DIR,
+            array_cache.array_cache_key(
+                volume,
+                encode=encode.__name__,
+                version=SLICE_ENCODING_VERSION,
+                compresslevel=OVERLAY_PNG_LEVEL,
+            ),
+        )
+        self.slice_cache.add_volume(name, volume, encode=encode, cache_dir=cache_dir)
+
+    def slice_urls(self, name):
+        """ The URLs of the slices of each view of a volume of the slice
+        cache. """
+        return [
+            [
+                slice_url(self.case_id, name, j, i)
+                for i in range(self.slice_cache.n_slices(name, j))
+            ]
+            for j in range(NUM_DIMS_DISPLAYED)
         ]
-        for j in range(NUM_DIMS_DISPLAYED)
-    ]
-    return fstc_slices
 
+    def seg_level_slices(self):
+        """ The URLs of the slices of the segment boundaries, for each level. """
+        return [
+            self.slice_urls(seg_level_volume(k)) for k in range(len(self.seg_levels))
+        ]
 
-if len(LOAD_SUPERPIXEL) > 0:
-    # load partitioned image (to save time)
-    if LOAD_SUPERPIXEL.endswith(".gz"):
-        import gzip
+    def figures(self):
+        """ The top and side figures, showing the first slices. """
+        return [
+            make_default_figure(
+                # the images are embedded so that their sizes can be read
+                images=[
+                    self.slice_cache.data_url(name, i, 0) for name in ["img", "seg"]
+                ],
+                width_scale=hwscales[i][1],
+                height_scale=hwscales[i][0],
+            )
+            for i in range(NUM_DIMS_DISPLAYED)
+        ]
 
-        with gzip.open(LOAD_SUPERPIXEL) as fd:
-            dat = np.load(fd)
-            segl = dat["segl"]
-            seg = dat["seg"]
-    else:
-        dat = np.load(LOAD_SUPERPIXEL)
-        segl = dat["segl"]
-        seg = dat["seg"]
-else:
-    # partition image
-    segl, seg = make_seg_image(img)
-
-if len(SAVE_SUPERPIXEL) > 0:
-    np.savez(SAVE_SUPERPIXEL, segl=segl, seg=seg)
-    exit(0)
-
-seg_img = img_as_ubyte(segl)
-img_slices, seg_slices = [
-    [
-        # top
-        [array_to_data_url(im[i, :, :]) for i in range(im.shape[0])],
-        # side
-        [array_to_data_url(im[:, i, :]) for i in range(im.shape[1])],
+    def figure_sizes(self):
+        """ The (width, height) of the images of the top and side figures,
+        which the coordinates of the shapes drawn on them refer to. """
+        sizes = []
+        for j in range(NUM_DIMS_DISPLAYED):
+            height, width = np.moveaxis(self.img, 0, j).shape[1:]
+            hscale, wscale = hwscales[j]
+            sizes.append((width * wscale, height * hscale))
+        return sizes
+
+    def found_segs_urls(self, labels):
+        """ Returns the URL of each slice of each view showing the segments with
+        the labels (a LabelSet). Slices not containing any of the labels are
+        left blank. A slice's URL only changes when the labels it contains
+        do, so only those slices are fetched and encoded again. """
+        selected = labels.mask()
+        fstc_slices = []
+        for j in range(NUM_DIMS_DISPLAYED):
+            slice_labels = self.seg_slice_labels.selected_slices(j, selected)
+            fstc_slices.append(
+                [
+                    found_slice_url(self.case_id, j, i, slice_labels[i])
+                    if i in slice_labels
+                    else BLANK_SLICE
+                    for i in range(self.seg.shape[j])
+                ]
+            )
+        return fstc_slices
+
+    def encode_found_slice(self, seg_slice, view, index, labels=()):
+        """ Encodes the found segments in a slice of seg as PNG, given the labels
+        of the found segments the slice contains. """
+        return encode_found_mask(self.seg_slice_labels.compose(view, index, labels))
+
+    def brain_mesh_trace(self):
+        """ Returns the Mesh3d trace of the brain surface (as a dict), computed
+        the first time it is needed and cached on disk with the superpixels. """
+        with self._brain_mesh_lock:
+            if self._brain_mesh_trace is None:
+                im = self.img.transpose((1, 2, 0))[:, :, ::-1]
+
+                def compute():
+                    verts, faces = mesh_utils.volume_mesh(
+                        im, 0, step_size=MESH_STEP_SIZE
+                    )
+                    return mesh_utils.decimate_mesh(verts, faces, BRAIN_MESH_FACES)
+
+                verts, faces = array_cache.load_or_compute_arrays(
+                    SUPERPIXEL_CACHE_DIR,
+                    array_cache.array_cache_key(
+                        self.img,
+                        step_size=MESH_STEP_SIZE,
+                        target_faces=BRAIN_MESH_FACES,
+                    ),
+                    ["brain-verts", "brain-faces"],
+                    compute,
+                )
+                self._brain_mesh_trace = mesh_utils.mesh_to_trace(
+                    verts, faces, binary=True, color="grey", opacity=0.5
+                )
+            return self._brain_mesh_trace
+
+
+def load_case(case_id):
+    path = case_paths().get(case_id)
+    if path is None:
+        raise KeyError("no case %s" % (case_id,))
+    return Case(case_id, path)
+
+
+# the cases are loaded when first requested and the least recently used ones
+# are dropped, with their caches, when more than CASE_CACHE_SIZE are loaded
+cases = CaseRegistry(load_case, maxsize=CASE_CACHE_SIZE)
+
+
+def precomputed_path(case_id):
+    """ The file recording that the caches of the case were filled with the
+    current parameters. """
+    key = array_cache.array_cache_key(
+        levels=SUPERPIXEL_LEVEL_FRACTIONS,
+        mesh_step_size=MESH_STEP_SIZE,
+        brain_mesh_faces=BRAIN_MESH_FACES,
+        slice_encoding_version=SLICE_ENCODING_VERSION,
+        overlay_png_level=OVERLAY_PNG_LEVEL,
+        **slic_params,
+    )
+    return os.path.join(PRECOMPUTE_DIR, "%s-%s.done" % (case_id, key))
+
+
+def precompute_running_path(case_id):
+    """ The file recording which server process is preparing the case, see
+    claim_precompute. """
+    return precomputed_path(case_id)[: -len(".done")] + ".running"
+
+
+def claim_precompute(case_id):
+    """ Records that this process prepares the case, unless another does.
+    The file is created exclusively, so only one of the server processes
+    polling a case gets to prepare it. It holds the ID of that process, or
+    "failed" and the time if preparing the case failed (see
+    record_precompute_failure). Returns whether the case was
+    claimed. """
+    os.makedirs(PRECOMPUTE_DIR, exist_ok=True)
+    try:
+        fd = os.open(
+            precompute_running_path(case_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+        )
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as fp:
+        fp.write(str(os.getpid()))
+    return True
+
+
+def read_precompute_owner(case_id):
+    """ Returns what the file written by claim_precompute holds, or None if
+    there is no such file. """
+    try:
+        with open(precompute_running_path(case_id)) as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def record_precompute_failure(case_id):
+    """ Records that preparing the case failed, so the server processes report
+    the failure instead of waiting for it, until PRECOMPUTE_RETRY_AFTER seconds
+    have passed. """
+    with open(precompute_running_path(case_id), "w") as fp:
+        fp.write("failed %f" % (time.time(),))
+
+
+def precompute_failure_expired(owner):
+    # the failures recorded without a time are retried at once
+    try:
+        failed_at = float(owner.split()[1])
+    except (IndexError, ValueError):
+        failed_at = 0
+    return time.time() - failed_at >= PRECOMPUTE_RETRY_AFTER
+
+
+def remove_precompute_claim(case_id):
+    try:
+        os.remove(precompute_running_path(case_id))
+    except FileNotFoundError:
+        # removed by another process
+        pass
+
+
+def precompute_owner_alive(owner):
+    # the server processes share PRECOMPUTE_DIR on one host, so a process ID
+    # that no longer exists means the process died while preparing the case
+    try:
+        os.kill(int(owner), 0)
+    except ValueError:
+        # the file is being written
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def precompute_status(case_id, path):
+    """ Returns the state of the preparation of the case, like
+    JobQueue.status, starting it in this process if no process is preparing
+    it. """
+    if os.path.exists(precomputed_path(case_id)):
+        return dict(state="done", progress=(0, 0, "Done"))
+    status = precompute_queue.status(case_id)
+    if status["state"] == "failed":
+        if read_precompute_owner(case_id) == str(os.getpid()):
+            # the job can fail without recording it, when the process running
+            # it dies (e.g. killed for lack of memory, which breaks the pool)
+            record_precompute_failure(case_id)
+        # the failure is reported from the file, until the case is retried
+    elif status["state"] != "unknown":
+        return status
+    if claim_precompute(case_id):
+        if os.path.exists(precomputed_path(case_id)):
+            # it was finished by another process since the check above
+            os.remove(precompute_running_path(case_id))
+            return dict(state="done", progress=(0, 0, "Done"))
+        precompute_queue.submit(case_id, path)
+        return precompute_queue.status(case_id)
+    owner = read_precompute_owner(case_id)
+    if owner is None:
+        # it just finished or failed, see on the next poll
+        return dict(state="running", progress=(0, 0, ""))
+    if owner.startswith("failed"):
+        if not precompute_failure_expired(owner):
+            return dict(state="failed", progress=(0, 0, ""))
+        # the case is claimed again and its job submitted again
+        remove_precompute_claim(case_id)
+        return precompute_status(case_id, path)
+    if not precompute_owner_alive(owner):
+        remove_precompute_claim(case_id)
+        return precompute_status(case_id, path)
+    return dict(
+        state="running", progress=(0, 0, "Being prepared by another server process"),
+    )
+
+
+def precompute_case(case_id, progress, path):
+    """ Prepares the case claimed by this server process (see
+    claim_precompute). Run in a worker process by precompute_queue, reporting
+    its progress in progress[case_id]. """
+    try:
+        fill_case_caches(case_id, progress, path)
+    except Exception:
+        record_precompute_failure(case_id)
+        raise
+    os.remove(precompute_running_path(case_id))
+
+
+def fill_case_caches(case_id, progress, path):
+    """ Fills the disk caches of the case: superpixels, meshes and encoded
+    slices. """
+    progress[case_id] = (0, 0, "Computing the superpixels")
+    case = Case(case_id, path)
+    progress[case_id] = (0, 0, "Computing the brain surface")
+    case.brain_mesh_trace()
+    slices = [
+        (name, j, i)
+        for name in ["img"] + [seg_level_volume(k) for k in range(len(case.seg_levels))]
+        for j in range(NUM_DIMS_DISPLAYED)
+        for i in range(case.slice_cache.n_slices(name, j))
     ]
-    for im in [img, seg_img]
-]
-# initially no slices have been found so we don't draw anything
-found_seg_slices = make_empty_found_segments()
-# store encoded blank slices for each view to save recomputing them for slices
-# containing no colored pixels
-blank_seg_slices = [found_seg_slices[0][0], found_seg_slices[1][0]]
-
-
-top_fig, side_fig = [
-    make_default_figure(
-        images=[img_slices[i][0], seg_slices[i][0]],
-        width_scale=hwscales[i][1],
-        height_scale=hwscales[i][0],
+    # the slices are encoded in a pool of threads, which run in parallel as the
+    # PNG encoders release the GIL while compressing
+    with ThreadPoolExecutor() as executor:
+        encoded = executor.map(lambda s: case.slice_cache.png(*s), slices)
+        for n, _ in enumerate(encoded):
+            progress[case_id] = (n, len(slices), "Encoding the slices")
+    os.makedirs(PRECOMPUTE_DIR, exist_ok=True)
+    open(precomputed_path(case_id), "w").close()
+    progress[case_id] = (len(slices), len(slices), "Done")
+
+
+# the cases that are opened before their caches are filled are prepared in
+# the background, so that no request waits for them. Each case is prepared by
+# one of the server processes, see claim_precompute
+precompute_queue = JobQueue(precompute_case, max_workers=PRECOMPUTE_WORKERS)
+
+
+@server.route(app.config.routes_pathname_prefix + "precompute/<case_id>")
+def serve_precompute(case_id):
+    """ Queues the case to be prepared, if it isn't, and returns the state of
+    its job. """
+    path = case_paths().get(case_id)
+    if path is None:
+        flask.abort(404)
+    return flask.jsonify(**precompute_status(case_id, path))
+
+
+def precompute_layout(case_id):
+    """ The page shown while a case is prepared, which reloads the case when
+    it is ready. """
+    return html.Div(
+        [
+            dcc.Location(id="precompute-location", refresh=True),
+            dcc.Store(id="precompute-case", data=case_id),
+            dcc.Interval(id="precompute-interval", interval=PRECOMPUTE_POLL_INTERVAL),
+            html.H6("Preparing case %s" % (case_id,)),
+            html.Div(id="precompute-status"),
+        ],
+        style={"padding": "20px"},
     )
-    for i in range(NUM_DIMS_DISPLAYED)
-]
+
+
+@app.callback(
+    [
+        Output("precompute-status", "children"),
+        Output("precompute-location", "href"),
+        Output("precompute-interval", "disabled"),
+    ],
+    [Input("precompute-interval", "n_intervals")],
+    [State("precompute-case", "data")],
+)
+
+#mostra o progresso da preparacao do caso e abre o caso quando estiver pronto
+def precompute_status_react(n_intervals, case_id):
+    status = precompute_status(case_id, case_paths()[case_id])
+    if status["state"] == "done":
+        href = app.get_relative_path("/main") + "?" + urlencode(dict(case=case_id))
+        return "Ready", href, True
+    if status["state"] == "failed":
+        message = (
+            "Preparing the case failed. It is tried again when the page is "
+            "reloaded %d s after the failure." % (PRECOMPUTE_RETRY_AFTER,)
+        )
+        return message, dash.no_update, True
+    done, total, message = status["progress"]
+    if total > 0:
+        message = "%s: %d / %d" % (message, done, total)
+    return message, dash.no_update, False
+
+
 
 default_3d_layout = dict(
     scene=dict(
@@ -424,10 +1081,10 @@ def login_logout_user(login_n_clicks, email, password, stored_email):
 
 @app.callback(
     Output('page-content', 'children'),
-    [Input('url', 'pathname')],
+    [Input('url', 'pathname'), Input('url', 'search')],
     [State('user-email-store', 'data')]
 )
-def display_page(pathname, user_email):
+def display_page(pathname, search, user_email):
     print(f"Pathname recebido: {pathname}") 
     if pathname == '/login' or pathname == '/':
         return login_layout()
@@ -436,13 +1093,42 @@ def display_page(pathname, user_email):
     elif pathname == '/profile' and user_email: 
         return profile_layout() 
     elif pathname == '/main' and user_email: 
-        return app_layout()
+        # the case to annotate is given as ?case=<ID>
+        case_id = parse_qs((search or "").lstrip("?")).get("case", [DEFAULT_CASE])[0]
+        path = case_paths().get(case_id)
+        if path is None:
+            return html.Div("Case %s not found." % (case_id,))
+        if case_id not in cases.loaded() and not os.path.exists(
+            precomputed_path(case_id)
+        ):
+            # the case is prepared in the background instead of in this request
+            precompute_status(case_id, path)
+            return precompute_layout(case_id)
+        return app_layout(case_id)
     else:
         return login_layout()
 
 
+@app.callback(
+    Output("url", "search"),
+    [Input("case-select", "value")],
+    [State("case-id", "data")],
+)
+
+#abre o caso escolhido
+def case_select_react(case_select_value, case_id):
+    if case_select_value is None or case_select_value == case_id:
+        raise PreventUpdate
+    return "?" + urlencode(dict(case=case_select_value))
+
+
 
-def app_layout():
+def app_layout(case_id=DEFAULT_CASE):
+    # everything shown comes from the case, which is loaded if it isn't
+    case = cases.get(case_id)
+    img_slices = case.slice_urls("img")
+    seg_level_slices = case.seg_level_slices()
+    top_fig, side_fig = case.figures()
     return html.Div([
         html.Div(
             id="main",
@@ -479,6 +1165,20 @@ def app_layout():
                                 ),
                             ],
                         ),
+                        html.Div(
+                            children=[
+                                dcc.Dropdown(
+                                    id="case-select",
+                                    options=[
+                                        dict(label=c, value=c)
+                                        for c in sorted(case_paths().keys())
+                                    ],
+                                    value=case_id,
+                                    clearable=False,
+                                ),
+                            ],
+                            style={"width": "300px", "marginLeft": "15px"},
+                        ),
                         
                         html.Div(
                             children=[
@@ -511,12 +1211,23 @@ def app_layout():
             style={"backgroundColor": "#F0F4F8"}
         ),
 
+        dcc.Store(id="case-id", data=case_id),
+        # the drawn shapes are kept on the server under this ID, the client
+        # only sends the slices whose shapes changed (see drawn_shapes_delta)
+        dcc.Store(id="session-id", data=new_session_id()),
+        dcc.Store(id="shapes-sent", data=dict(version=0, shapes=None)),
+        dcc.Store(id="shapes-delta", data=None),
+        # clicked when the server asks for all the shapes, see
+        # request_shapes_resync
+        html.Button(id="shapes-resync-button", style={"display": "none"}),
         dcc.Store(id="image-slices", data=img_slices),
-        dcc.Store(id="seg-slices", data=seg_slices),
+        dcc.Store(id="seg-slices", data=seg_level_slices[0]),
+        dcc.Store(id="seg-level-slices", data=seg_level_slices),
         dcc.Store(
             id="drawn-shapes",
             data=[
-                [[] for _ in range(seg_img.shape[i])] for i in range(NUM_DIMS_DISPLAYED)
+                [[] for _ in range(case.img.shape[i])]
+                for i in range(NUM_DIMS_DISPLAYED)
             ],
         ),
         dcc.Store(id="slice-number-top", data=0),
@@ -529,7 +1240,7 @@ def app_layout():
                 undo_shapes=[],
                 redo_shapes=[],
                 empty_shapes=[
-                    [[] for _ in range(seg_img.shape[i])]
+                    [[] for _ in range(case.img.shape[i])]
                     for i in range(NUM_DIMS_DISPLAYED)
                 ],
             ),
@@ -538,7 +1249,6 @@ def app_layout():
         html.Div(
             id="loader-wrapper",
             children=[
-                html.Div(id="dummy", style={"display": "none"}),
                 html.Div(id="dummy2", style={"display": "none"}, children=",0"),
                 html.Div(
                     id="show-hide-seg-2d", children="show", style={"display": "none"}
@@ -550,8 +1260,6 @@ def app_layout():
                     id="graph-loading",
                     type="circle",
                     children=[
-                        html.A(id="download-link", download="found_image.nii"),
-                        dcc.Store(id="found-image-tensor-data", data=""),
                         html.Div(
                             children=[
                                 html.Button(
@@ -578,26 +1286,39 @@ def app_layout():
                                         "cursor": "pointer",
                                     },
                                 ),
-                                html.Button(
+                                # the downloads are links to files streamed by
+                                # serve_download
+                                html.A(
                                     "Download Brain Volume",
                                     id="download-brain-button",
+                                    href=download_url(case_id, "brain"),
                                     style={
-                                        "width": "auto",                                    
+                                        "width": "auto",
                                         "backgroundColor": "#005F73",
                                         "color": "white",
                                         "border": "none",
                                         "cursor": "pointer",
+                                        "display": "flex",
+                                        "alignItems": "center",
+                                        "padding": "0 6px",
+                                        "textDecoration": "none",
                                     },
                                 ),
-                                html.Button(
+                                html.A(
                                     "Download Selected Partitions",
                                     id="download-button",
+                                    # set when segments are selected
+                                    href=None,
                                     style={
-                                        "width": "auto",                                    
+                                        "width": "auto",
                                         "backgroundColor": "#005F73",
                                         "color": "white",
                                         "border": "none",
                                         "cursor": "pointer",
+                                        "display": "flex",
+                                        "alignItems": "center",
+                                        "padding": "0 6px",
+                                        "textDecoration": "none",
                                     },
                                 ),
                                 html.Button(
@@ -624,6 +1345,45 @@ def app_layout():
                                         "cursor": "pointer",
                                     },
                                 ),
+                                html.Button(
+                                    "Grow Selection",
+                                    id="grow-selection-button",
+                                    n_clicks=0,
+                                    style={
+                                        "width": "auto",
+                                        "backgroundColor": "#005F73",
+                                        "color": "white",
+                                        "border": "none",
+                                        "cursor": "pointer",
+                                    },
+                                ),
+                                html.Div(
+                                    [
+                                        html.Div(
+                                            "Granularity",
+                                            style={"padding": "5px"},
+                                        ),
+                                        html.Div(
+                                            dcc.Slider(
+                                                id="superpixel-level",
+                                                min=0,
+                                                max=len(case.seg_levels) - 1,
+                                                step=1,
+                                                value=0,
+                                                marks={
+                                                    len(case.seg_levels) - 1: "Coarse",
+                                                    0: "Fine",
+                                                },
+                                            ),
+                                            style={"flexGrow": "1"},
+                                        ),
+                                    ],
+                                    style={
+                                        "display": "flex",
+                                        "alignItems": "center",
+                                        "flexGrow": "1",
+                                    },
+                                ),
                             ],
                             style={"display": "flex",},
                         ),
@@ -775,7 +1535,9 @@ def app_layout():
                 "boxShadow": "0px 2px 4px rgba(0, 0, 0, 0.1)"
             },
         ),
-        dcc.Store(id="found-segs", data=found_seg_slices),
+        dcc.Store(id="found-segs", data=make_empty_found_segments(case.img.shape)),
+        dcc.Store(id="found-segs-delta", data=None),
+        dcc.Store(id="grown-labels", data=None),
     ],
 ),
         html.Div(
@@ -801,8 +1563,10 @@ def app_layout():
             ],
         ),
         dcc.Store(id="fig-3d-scene", data=default_3d_layout),
-        dcc.Store(id="current-render-id", data=0),
-        dcc.Store(id="last-render-id", data=0),
+        # the 3D figure with its arrays encoded in base64, as sent by the server
+        dcc.Store(id="fig-3d-encoded", data=None),
+        dcc.Store(id="current-render-id", data=INITIAL_RENDER_ID),
+        dcc.Store(id="last-render-id", data=INITIAL_RENDER_ID),
     ])
 
 app.clientside_callback(
@@ -823,6 +1587,19 @@ function (show_seg_n_clicks) {
     [Input("show-seg-check", "n_clicks")],
 )
 
+# switching the granularity only changes which of the precomputed boundary
+# images are shown
+app.clientside_callback(
+    """
+function(superpixel_level, seg_level_slices_data) {
+    return seg_level_slices_data[superpixel_level];
+}
+""",
+    Output("seg-slices", "data"),
+    [Input("superpixel-level", "value")],
+    [State("seg-level-slices", "data")],
+)
+
 app.clientside_callback(
     """
 function(
@@ -830,11 +1607,11 @@ function(
     image_select_side_value,
     show_hide_seg_2d,
     found_segs_data,
+    seg_slices_data,
     image_slices_data,
     image_display_top_figure,
     image_display_side_figure,
-    seg_slices_data,
-    drawn_shapes_data) {{
+    drawn_shapes_data) {
     let show_seg_check = show_hide_seg_2d;
     let image_display_figures_ = figure_display_update(
         [image_select_top_value,image_select_side_value],
@@ -854,35 +1631,33 @@ function(
     sizex = top_figure.layout.images[0].sizex,
     sizey = top_figure.layout.images[0].sizey;
     // tri_shape draws the triangular shape, see assets/app_clientside.js
-    if (top_figure.layout.shapes) {{
+    if (top_figure.layout.shapes) {
         top_figure.layout.shapes=top_figure.layout.shapes.concat([
             tri_shape(d/2,sizey*image_select_side_value/found_segs_data[1].length,
                       d/2,d/2,'right'),
             tri_shape(sizex-d/2,sizey*image_select_side_value/found_segs_data[1].length,
                       d/2,d/2,'left'),
         ]);
-    }}
+    }
     sizex = side_figure.layout.images[0].sizex,
     sizey = side_figure.layout.images[0].sizey;
-    if (side_figure.layout.shapes) {{
+    if (side_figure.layout.shapes) {
         side_figure.layout.shapes=side_figure.layout.shapes.concat([
             tri_shape(d/2,sizey*image_select_top_value/found_segs_data[0].length,
                       d/2,d/2,'right'),
             tri_shape(sizex-d/2,sizey*image_select_top_value/found_segs_data[0].length,
                       d/2,d/2,'left'),
         ]);
-    }}
+    }
     // return the outputs
     return image_display_figures_.concat([
-    "Slice: " + (image_select_top_value+1) + " / {num_top_slices}",
-    "Slice: " + (image_select_side_value+1) + " / {num_side_slices}",
+    "Slice: " + (image_select_top_value+1) + " / " + image_slices_data[0].length,
+    "Slice: " + (image_select_side_value+1) + " / " + image_slices_data[1].length,
     image_select_top_value,
     image_select_side_value
     ]);
-}}
-""".format(
-        num_top_slices=len(img_slices[0]), num_side_slices=len(img_slices[1])
-    ),
+}
+""",
     [
         Output("image-display-graph-top", "figure"),
         Output("image-display-graph-side", "figure"),
@@ -896,12 +1671,12 @@ function(
         Input("image-select-side", "value"),
         Input("show-hide-seg-2d", "children"),
         Input("found-segs", "data"),
+        Input("seg-slices", "data"),
     ],
     [
         State("image-slices", "data"),
         State("image-display-graph-top", "figure"),
         State("image-display-graph-side", "figure"),
-        State("seg-slices", "data"),
         State("drawn-shapes", "data"),
     ],
 )
@@ -968,51 +1743,248 @@ undo_data)
 )
 
 
+# only the slices whose shapes changed are sent to the server, see
+# assets/app_clientside.js
+app.clientside_callback(
+    """
+function (drawn_shapes_data, resync_n_clicks, shapes_sent) {
+    if (!drawn_shapes_data) {
+        return [window.dash_clientside.no_update,
+                window.dash_clientside.no_update];
+    }
+    let triggered = window.dash_clientside.callback_context.triggered.map(
+        t => t['prop_id'])[0];
+    return drawn_shapes_delta(drawn_shapes_data, shapes_sent,
+                              triggered === "shapes-resync-button.n_clicks");
+}
+""",
+    [Output("shapes-delta", "data"), Output("shapes-sent", "data")],
+    [Input("drawn-shapes", "data"), Input("shapes-resync-button", "n_clicks")],
+    [State("shapes-sent", "data")],
+)
+
+
+class AnnotationSession:
+    """ What the server keeps of a client annotating a case: a copy of the
+    shapes it drew (at the version it last sent), the labels of the slices
+    drawn on, the labels added by growing the selection, the labels
+    of the segments found and the found segments slices last sent. """
+
+    def __init__(self, case_id, n_labels):
+        self.case_id = case_id
+        self.version = None
+        self.shapes = None
+        # the labels of the slices drawn on (and their masks if DEBUG_MASK,
+        # which are not pickled), so that only the slices whose shapes changed
+        # are re-rasterized
+        self.shape_cache = SliceShapeCache(keep_masks=DEBUG_MASK)
+        # the selections are LabelSets of the segments, what is shown of them
+        # is derived from their labels when it is needed
+        self.grown_labels = LabelSet(n_labels)
+        self.labels = LabelSet(n_labels)
+        # the found segments slices of the last render and its ID, so that
+        # only the slices that changed since are sent (see found_segs_delta)
+        self.render_id = None
+        self.render_slices = None
+
+    def apply_delta(self, shapes_delta):
+        """ Brings the shapes up to date with a delta sent by
+        drawn_shapes_delta. Returns False if the delta is based on a version
+        of the shapes the session doesn't have, and so can't be applied. """
+        if shapes_delta["version"] == self.version:
+            # already applied, the callback was triggered by something else
+            return True
+        if shapes_delta["base"] is None:
+            self.shapes = shapes_delta["full"]
+        elif shapes_delta["base"] == self.version:
+            self.shapes = [list(view_shapes) for view_shapes in self.shapes]
+            for j, i, shapes in shapes_delta["changes"]:
+                self.shapes[j][i] = shapes
+        else:
+            return False
+        self.version = shapes_delta["version"]
+        return True
+
+    def has_shapes(self):
+        return self.shapes is not None and any(
+            len(shapes) > 0 for view in self.shapes for shapes in view
+        )
+
+
+# the annotation sessions, by the session ID of the page
+sessions = SessionStore(
+    maxsize=SESSION_CACHE_SIZE,
+    directory=SESSION_DIR if len(SESSION_DIR) > 0 else None,
+    max_age=SESSION_MAX_AGE,
+)
+
+
+def get_session(session_id, case):
+    """ Returns the annotation session of the case, or None if there is none
+    (the session IDs are made per page, each showing one case). The sessions
+    are only made from all the shapes of a client, see draw_shapes_react. """
+    session = sessions.get(session_id)
+    if session is None or session.case_id != case.case_id:
+        return None
+    return session
+
+
+def shapes_resync():
+    """ The answer asking the client for all its shapes, which it sends
+    without waiting for the next change (see request_shapes_resync). """
+    return dict(shapes_resync=uuid.uuid4().hex)
+
+
+def update_shape_cache(case, session):
+    """ Rasterizes the shapes of the session on the slices whose shapes changed
+    since the last call and finds the labels beneath them. """
+    # the shapes are in the coordinates of the first layout image (this will be
+    # one of the images of the brain), which give the bounding box of the SVG
+    # that we want to rasterize
+    sizes = case.figure_sizes()
+
+    def rasterize(j, i, shapes):
+        width, height = sizes[j]
+        hscale, wscale = hwscales[j]
+        mask = shape_utils.shapes_to_mask(
+            [dict(width=width, height=height, shape=s) for s in shapes],
+            # we only have one label class, so the mask is given value 1
+            1,
+        )
+        # TODO: Maybe there's a more elegant way to downsample the mask?
+        return mask[::hscale, ::wscale]
+
+    def find_labels(j, i, mask):
+        # find labels beneath the mask
+        return set(np.unique(np.moveaxis(case.seg, 0, j)[i][mask == 1]))
+
+    # only the slices whose shapes changed since the last call are rasterized
+    session.shape_cache.update(session.shapes or [], rasterize, find_labels)
+
+
 #converte formas desenhadas pelo usuario em segmentos na imagem, usa essas formas 
 #para determinar quais partes da imagem devem ser considerados como encontradas ou selecionadas
-def shapes_to_segs(
-    drawn_shapes_data, image_display_top_figure, image_display_side_figure,
-):
-    masks = np.zeros_like(img)
-    for j, (graph_figure, (hscale, wscale)) in enumerate(
-        zip([image_display_top_figure, image_display_side_figure], hwscales)
-    ):
-        fig = go.Figure(**graph_figure)
-        # we use the width and the height of the first layout image (this will be
-        # one of the images of the brain) to get the bounding box of the SVG that we
-        # want to rasterize
-        width, height = [fig.layout.images[0][sz] for sz in ["sizex", "sizey"]]
-        for i in range(seg_img.shape[j]):
-            shape_args = [
-                dict(width=width, height=height, shape=s)
-                for s in drawn_shapes_data[j][i]
-            ]
-            if len(shape_args) > 0:
-                mask = shape_utils.shapes_to_mask(
-                    shape_args,
-                    # we only have one label class, so the mask is given value 1
-                    1,
-                )
-                # TODO: Maybe there's a more elegant way to downsample the mask?
-                np.moveaxis(masks, 0, j)[i, :, :] = mask[::hscale, ::wscale]
-    found_segs_tensor = np.zeros_like(img)
-    if DEBUG_MASK:
-        found_segs_tensor[masks == 1] = 1
-    else:
-        # find labels beneath the mask
-        labels = set(seg[1 == masks])
-        # for each label found, select all of the segment with that label
-        for l in labels:
-            found_segs_tensor[seg == l] = 1
+def shapes_to_labels(case, session, level=0):
+    """ Updates and returns the labels of the session: the labels of the
+    segments of the case beneath its shapes, or of the segments making up their
+    regions at the given level of its seg_levels, plus the labels added by
+    growing the selection. """
+    if not session.has_shapes():
+        # the grown segments are forgotten when all the shapes are removed
+        session.grown_labels = LabelSet(case.seg_index.n_labels)
+    update_shape_cache(case, session)
+    labels = rag_utils.level_members(
+        case.seg_levels, level, session.shape_cache.labels()
+    )
+    session.labels = session.grown_labels | labels
+    return session.labels
+
+
+#monta o volume dos segmentos encontrados, so quando um volume e realmente necessario
+def shapes_to_segs(case, session):
+    """ Returns the volume of the session's selection (or of the masks of its
+    shapes if DEBUG_MASK), only made when a volume is really needed. """
+    if not DEBUG_MASK:
+        # select all of the segments with the labels found
+        return case.seg_index.mask(session.labels, dtype=case.img.dtype)
+    # the masks are not pickled with the session, so they may have to be made
+    # again
+    update_shape_cache(case, session)
+    found_segs_tensor = np.zeros_like(case.img)
+    for (j, i), mask in session.shape_cache.masks():
+        np.moveaxis(found_segs_tensor, 0, j)[i][mask == 1] = 1
     return found_segs_tensor
 
 
 @app.callback(
-    [Output("found-segs", "data"), Output("current-render-id", "data")],
-    [Input("drawn-shapes", "data")],
+    Output("grown-labels", "data"),
+    [Input("grow-selection-button", "n_clicks")],
     [
-        State("image-display-graph-top", "figure"),
-        State("image-display-graph-side", "figure"),
+        State("session-id", "data"),
+        State("case-id", "data"),
+        State("superpixel-level", "value"),
+    ],
+)
+
+#expande a selecao para os segmentos vizinhos com intensidade parecida
+def grow_selection_react(
+    grow_selection_n_clicks, session_id, case_id, superpixel_level,
+):
+    if not grow_selection_n_clicks:
+        raise PreventUpdate
+    case = cases.get(case_id)
+    # the session is changed under its lock, as other callbacks (possibly in
+    # other processes) may change it at the same time
+    with sessions.lock(session_id):
+        session = get_session(session_id, case)
+        if session is None:
+            # the shapes are not known, draw_shapes_react (triggered by the new
+            # value) asks the client for them, then the user can grow again
+            return new_session_id()
+        labels = shapes_to_labels(case, session, superpixel_level)
+        grown = rag_utils.grow_selection(case.seg_rag, labels, GROW_TOLERANCE)
+        # only the segments added by growing are kept, the others follow the
+        # shapes
+        session.grown_labels |= LabelSet(labels.n_labels, grown) - labels
+        sessions.put(session_id, session)
+        # the grown labels are kept in the session, the store only triggers
+        # draw_shapes_react
+        return session.grown_labels.encode()
+
+
+# the RGBA colors of the found segments, by value (1 where found, 0 elsewhere)
+FOUND_SEGS_LUT = image_utils.label_colormap_lut(
+    2,
+    colormap=["#8A2BE2"],
+    alpha=[128],
+    # we map label 0 to the color #000000 using no_map_zero, so we start at
+    # color_class 1
+    color_class_offset=1,
+    no_map_zero=True,
+)
+# the palette and opacities of the found segments PNGs, the colors of
+# FOUND_SEGS_LUT
+FOUND_SEGS_PALETTE = dict(colors=["#000000", "#8A2BE2"], alpha=[0, 128])
+
+
+def encode_found_mask(found):
+    """ Encodes a slice of the found segments, 1 where found and 0 elsewhere,
+    as PNG. """
+    return png_utils.palette_png_bytes(
+        found, compresslevel=OVERLAY_PNG_LEVEL, **FOUND_SEGS_PALETTE
+    )
+
+
+def found_segs_delta(session, fstc_slices, base_render_id):
+    """ Records the rendered found segments slices in the session under a new
+    render ID and returns what the client with the render base_render_id needs
+    to get them: only the (view, slice, url) entries that changed if that
+    render is the last one of the session, otherwise all the slices. """
+    render_id = uuid.uuid4().hex
+    base = session.render_slices if session.render_id == base_render_id else None
+    session.render_id = render_id
+    session.render_slices = fstc_slices
+    if base is None:
+        return dict(render_id=render_id, base=None, full=fstc_slices)
+    changes = [
+        [j, i, url]
+        for j, (view_slices, base_view_slices) in enumerate(zip(fstc_slices, base))
+        for i, (url, base_url) in enumerate(zip(view_slices, base_view_slices))
+        if url != base_url
+    ]
+    return dict(render_id=render_id, base=base_render_id, changes=changes)
+
+
+@app.callback(
+    [Output("found-segs-delta", "data"), Output("download-button", "href")],
+    [
+        Input("shapes-delta", "data"),
+        Input("grown-labels", "data"),
+        Input("superpixel-level", "value"),
+    ],
+    [
+        State("session-id", "data"),
+        State("case-id", "data"),
         State("current-render-id", "data"),
     ],
 )
@@ -1020,171 +1992,89 @@ def shapes_to_segs(
 #callback q reage ao desenho de formas pelo usuario, atualiza os segmentos
 #encontrados com base nas formas desenahdas
 def draw_shapes_react(
-    drawn_shapes_data,
-    image_display_top_figure,
-    image_display_side_figure,
+    shapes_delta,
+    grown_labels,
+    superpixel_level,
+    session_id,
+    case_id,
     current_render_id,
 ):
-    if any(
-        [
-            e is None
-            for e in [
-                drawn_shapes_data,
-                image_display_top_figure,
-                image_display_side_figure,
-            ]
-        ]
-    ):
-        return dash.no_update
+    if shapes_delta is None:
+        return (dash.no_update, dash.no_update)
+    case = cases.get(case_id)
+    with sessions.lock(session_id):
+        session = get_session(session_id, case)
+        if session is None:
+            if shapes_delta["base"] is not None:
+                # the session was dropped, the client sends all the shapes again
+                return (shapes_resync(), dash.no_update)
+            session = AnnotationSession(case.case_id, case.seg_index.n_labels)
+        if not session.apply_delta(shapes_delta):
+            # the session doesn't have the shapes the changes are relative to
+            return (shapes_resync(), dash.no_update)
+        result = render_session(case, session, superpixel_level, current_render_id)
+        sessions.put(session_id, session)
+    return result
+
+
+def render_session(case, session, level, current_render_id):
+    """ Updates the labels of the session and returns the changes of the found
+    segments for the client and the link to download them. """
     t1 = time.time()
-    found_segs_tensor = shapes_to_segs(
-        drawn_shapes_data, image_display_top_figure, image_display_side_figure,
-    )
+    labels = shapes_to_labels(case, session, level)
     t2 = time.time()
     PRINT("Time to convert shapes to segments:", t2 - t1)
-    # convert to a colored image
-    fst_colored = image_utils.label_to_colors(
-        found_segs_tensor,
-        colormap=["#8A2BE2"],
-        alpha=[128],
-        # we map label 0 to the color #000000 using no_map_zero, so we start at
-        # color_class 1
-        color_class_offset=1,
-        labels_contiguous=True,
-        no_map_zero=True,
-    )
-    t3 = time.time()
-    PRINT("Time to convert from labels to colored image:", t3 - t2)
-    fstc_slices = [
-        [
-            array_to_data_url(s) if np.any(s != 0) else blank_seg_slices[j]
-            for s in np.moveaxis(fst_colored, 0, j)
-        ]
-        for j in range(NUM_DIMS_DISPLAYED)
-    ]
-    t4 = time.time()
-    PRINT("Time to convert to data URLs:", t4 - t3)
-    PRINT("Total time to compute 2D annotations:", t4 - t1)
-    return fstc_slices, current_render_id + 1
-
-
-def _decode_b64_slice(s):
-    return base64.b64decode(s.encode())
-
-
-#converte uma lista de imagens codificadas em base64 de volta p um array numpy
-#permite manipulacao e analise posterior das imagens
-def slice_image_list_to_ndarray(fstc_slices):
-    # convert encoded slices to array
-    # TODO eventually make it format agnostic, right now we just assume png and
-    # strip off length equal to uri_header from the uri string
-    uri_header = "data:image/png;base64,"
-    # preallocating the final tensor by reading the first image makes converting
-    # much faster (because all the images have the same dimensions)
-    n_slices = len(fstc_slices)
-    first_img = plot_common.str_to_img_ndarrary(
-        _decode_b64_slice(fstc_slices[0][len(uri_header) :])
-    )
-    fstc_ndarray = np.zeros((n_slices,) + first_img.shape, dtype=first_img.dtype)
-    PRINT("first_img.dtype", first_img.dtype)
-    fstc_ndarray[0] = first_img
-    for n, img_slice in enumerate(fstc_slices[1:]):
-        img = plot_common.str_to_img_ndarrary(
-            _decode_b64_slice(img_slice[len(uri_header) :])
-        )
-        fstc_ndarray[n] = img
-    PRINT("fstc_ndarray.shape", fstc_ndarray.shape)
-    # transpose back to original
-    if len(fstc_ndarray.shape) == 3:
-        # Brain data is lacking the 4th channel dimension
-        # Here we allow for this function to also return an array for the 3D brain data
-        return fstc_ndarray.transpose((1, 2, 0))
-    return fstc_ndarray.transpose((1, 2, 0, 3))
-
-
-
-#converte fatias encontradas em um arquivo nii e condifica em base64 p download
-# Converts found slices to nii file and encodes in b64 so it can be downloaded
-def save_found_slices(fstc_slices):
-    # we just save the first view (it makes no difference in the end)
-    fstc_slices = fstc_slices[0]
-    fstc_ndarray = slice_image_list_to_ndarray(fstc_slices)
-    # if the tensor is all zero (no partitions found) return None
-    if np.all(fstc_ndarray == 0):
-        return None
-    # TODO add affine
-    # technique for writing nii to bytes from here:
-    # https://gist.github.com/arokem/423d915e157b659d37f4aded2747d2b3
-    fstc_nii = nib.Nifti1Image(skimage.img_as_ubyte(fstc_ndarray), affine=None)
-    fstcbytes = io.BytesIO()
-    file_map = fstc_nii.make_file_map({"image": fstcbytes, "header": fstcbytes})
-    fstc_nii.to_file_map(file_map)
-    fstcb64 = base64.b64encode(fstcbytes.getvalue()).decode()
-    return fstcb64
-
-
-@app.callback(
-    Output("found-image-tensor-data", "data"),
-    [Input("download-button", "n_clicks"), Input("download-brain-button", "n_clicks")],
-    [State("found-segs", "data"), State("image-slices", "data")],
-)
-def download_button_react(
-    download_button_n_clicks,
-    download_brain_button_n_clicks,
-    found_segs_data,
-    brain_data,
-):
-    ctx = dash.callback_context
-    # Find out which download button was triggered
-    if not ctx.triggered:
-        # Nothing has happened yet
-        return ""
-    trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
-    if trigger_id == "download-button":
-        ret = save_found_slices(found_segs_data)
-    elif trigger_id == "download-brain-button":
-        ret = save_found_slices(brain_data)
+    if DEBUG_MASK:
+        # the mask is not a union of segments, so it is sent encoded, the
+        # slices drawn on being encoded together in a pool of threads
+        found = shapes_to_segs(case, session)
+        fstc_slices = []
+        for j in range(NUM_DIMS_DISPLAYED):
+            view_slices = np.moveaxis(found, 0, j)
+            drawn = [i for i in range(len(view_slices)) if np.any(view_slices[i])]
+            pngs = png_utils.palette_pngs_bytes(
+                [view_slices[i] for i in drawn],
+                compresslevel=OVERLAY_PNG_LEVEL,
+                **FOUND_SEGS_PALETTE,
+            )
+            urls = dict(zip(drawn, map(plot_common.png_bytes_to_uri, pngs)))
+            fstc_slices.append(
+                [urls.get(i, BLANK_SLICE) for i in range(len(view_slices))]
+            )
+        # the downloads are made of whole segments
+        download_href = None
     else:
-        return ""
-
-    if ret is None:
-        return ""
-    return ret
+        # the slices are only rendered when the browser requests them
+        fstc_slices = case.found_segs_urls(labels)
+        # the download is streamed from the labels, nothing is computed now
+        download_href = (
+            download_url(case.case_id, "found", labels) if len(labels) > 0 else None
+        )
+    t3 = time.time()
+    PRINT("Total time to compute 2D annotations:", t3 - t1)
+    # only send the slices that changed since the render the client has
+    return (found_segs_delta(session, fstc_slices, current_render_id), download_href)
 
 
 app.clientside_callback(
     """
-function (found_image_tensor_data) {
-    if (found_image_tensor_data.length <= 0) {
-        return "";
+function (found_segs_delta, found_segs_data, current_render_id) {
+    if (found_segs_delta && ("shapes_resync" in found_segs_delta)) {
+        // the server asks for all the shapes, see assets/app_clientside.js
+        request_shapes_resync();
+        return [window.dash_clientside.no_update,
+                window.dash_clientside.no_update];
     }
-    // for some reason you can't use the conversion to ascii from base64 directly
-    // with blob, you have to use the ascii encoded as numbers
-    const byte_chars = window.atob(found_image_tensor_data);
-    const byte_numbers = Array.from(byte_chars,(b,i)=>byte_chars.charCodeAt(i));
-    const byte_array = new Uint8Array(byte_numbers);
-    let b = new Blob([byte_array],{type: 'application/octet-stream'});
-    let url = URL.createObjectURL(b);
-    return url;
+    // see assets/app_clientside.js
+    return found_segs_apply_delta(found_segs_delta, found_segs_data,
+                                  current_render_id);
 }
 """,
-    Output("download-link", "href"),
-    [Input("found-image-tensor-data", "data")],
+    [Output("found-segs", "data"), Output("current-render-id", "data")],
+    [Input("found-segs-delta", "data")],
+    [State("found-segs", "data"), State("current-render-id", "data")],
 )
 
-app.clientside_callback(
-    """
-function (href) {
-    if (href != "") {
-        let download_a=document.getElementById("download-link");
-        download_a.click();
-    }
-    return '';
-}
-""",
-    Output("dummy", "children"),
-    [Input("download-link", "href")],
-)
 
 app.clientside_callback(
     """
@@ -1238,15 +2128,15 @@ def store_scene_data(graph_3d_relayoutData, last_3d_scene):
     return dash.no_update
 
 
+
 @app.callback(
-    [Output("image-display-graph-3d", "figure"), Output("last-render-id", "data")],
+    [Output("fig-3d-encoded", "data"), Output("last-render-id", "data")],
     [Input("dummy2", "children"), Input("show-hide-seg-3d", "children")],
     [
-        State("drawn-shapes", "data"),
+        State("session-id", "data"),
+        State("case-id", "data"),
         State("fig-3d-scene", "data"),
         State("last-render-id", "data"),
-        State("image-display-graph-top", "figure"),
-        State("image-display-graph-side", "figure"),
     ],
 )
 
@@ -1255,21 +2145,19 @@ def store_scene_data(graph_3d_relayoutData, last_3d_scene):
 def populate_3d_graph(
     dummy2_children,
     show_hide_seg_3d,
-    drawn_shapes_data,
+    session_id,
+    case_id,
     last_3d_scene,
     last_render_id,
-    image_display_top_figure,
-    image_display_side_figure,
 ):
     # extract which graph shown and the current render id
     graph_shown, current_render_id = dummy2_children.split(",")
-    current_render_id = int(current_render_id)
     start_time = time.time()
     cbcontext = [p["prop_id"] for p in dash.callback_context.triggered][0]
     # check that we're not toggling the display of the 3D annotation
     if cbcontext != "show-hide-seg-3d.children":
         PRINT(
-            "might render 3D, current_id: %d, last_id: %d"
+            "might render 3D, current_id: %s, last_id: %s"
             % (current_render_id, last_render_id)
         )
         if graph_shown != "3d shown" or current_render_id == last_render_id:
@@ -1277,33 +2165,64 @@ def populate_3d_graph(
                 PRINT("not rendering 3D because it is up to date")
             return dash.no_update
     PRINT("rendering 3D")
-    segs_ndarray = shapes_to_segs(
-        drawn_shapes_data, image_display_top_figure, image_display_side_figure,
-    ).transpose((1, 2, 0))
-    # image, color
-    images = [
-        (img.transpose((1, 2, 0))[:, :, ::-1], "grey"),
-    ]
+    case = cases.get(case_id)
+    # the labels were updated by draw_shapes_react when the shapes changed
+    session = get_session(session_id, case)
+    if session is None:
+        # the shapes are not known, the client sends them, and the 3D view is
+        # rendered again the next time it is shown
+        return (shapes_resync(), dash.no_update)
+    # the brain does not change, so its mesh is only computed once
+    data = [case.brain_mesh_trace()]
     if show_hide_seg_3d == "show":
-        images.append((segs_ndarray[:, :, ::-1], "purple"))
-    data = []
-    for im, color in images:
-        im = image_utils.combine_last_dim(im)
-        try:
-            verts, faces, normals, values = measure.marching_cubes(im, 0, step_size=3)
-            x, y, z = verts.T
-            i, j, k = faces.T
+        if DEBUG_MASK:
+            with sessions.lock(session_id):
+                segs_ndarray = shapes_to_segs(case, session).transpose((1, 2, 0))
+            im = image_utils.combine_last_dim(segs_ndarray[:, :, ::-1])
+            verts, faces = mesh_utils.volume_mesh(im, 0, step_size=MESH_STEP_SIZE)
+        else:
+            # the annotation is a union of segments, so its mesh is made of the
+            # precomputed meshes of the segments
+            verts, faces = case.seg_meshes.mesh(session.labels.labels())
+        if len(faces) > 0:
             data.append(
-                go.Mesh3d(x=x, y=y, z=z, color=color, opacity=0.5, i=i, j=j, k=k)
+                mesh_utils.mesh_to_trace(
+                    verts, faces, binary=True, color="purple", opacity=0.5
+                )
             )
-        except RuntimeError:
-            continue
-    fig = go.Figure(data=data)
-    fig.update_layout(**last_3d_scene)
+    layout = go.Layout()
+    layout.update(**last_3d_scene)
+    # the traces are already in their serialized form, so the figure is
+    # returned as a dict to avoid validating them again. Their arrays are
+    # decoded in the browser, see decode_figure_arrays.
+    fig = dict(data=data, layout=layout.to_plotly_json())
     end_time = time.time()
     PRINT("serverside 3D generation took: %f seconds" % (end_time - start_time,))
     return (fig, current_render_id)
 
 
+app.clientside_callback(
+    """
+function (fig_3d_encoded) {
+    if (!fig_3d_encoded) {
+        return window.dash_clientside.no_update;
+    }
+    if ("shapes_resync" in fig_3d_encoded) {
+        // the server asks for all the shapes, see assets/app_clientside.js
+        request_shapes_resync();
+        return window.dash_clientside.no_update;
+    }
+    // see assets/app_clientside.js
+    return decode_figure_arrays(fig_3d_encoded);
+}
+""",
+    Output("image-display-graph-3d", "figure"),
+    [Input("fig-3d-encoded", "data")],
+)
+
+
+# the default case is loaded at startup
+cases.get(DEFAULT_CASE)
+
 if __name__ == "__main__":
     app.run_server(debug=True)
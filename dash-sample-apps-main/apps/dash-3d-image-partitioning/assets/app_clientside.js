@@ -13,7 +13,8 @@ function figure_display_update (
     found_segs_data,
     // an array of length equal to the number of figures, each containing an
     // array equal to the number of slices for that view. Each item of this
-    // array is a uri encoded image
+    // array is the URL of an image, only the one of the slice shown is fetched
+    // by the browser
     image_slices_data,
     // an array containing the figures, in the same order as slice_indices
     image_display_figures,
@@ -85,3 +86,111 @@ function tri_shape (x,y,w=2.5,h=2.5,o='down',path_args={
        ...path_args
     };
 }
+
+// Merge the found segments slices that changed, as sent by the server, into
+// the found segments data the client has.
+// returns the new found segments data and its render ID
+function found_segs_apply_delta (
+    // an object containing the render_id of the new found segments and either
+    // the full found segments data in "full" or, in "changes", an array of
+    // [view, slice, source] for the slices that changed since the render "base"
+    found_segs_delta,
+    // the found segments data the client has
+    found_segs_data,
+    // the render ID of found_segs_data
+    current_render_id) {
+    if (!found_segs_delta) {
+        return [window.dash_clientside.no_update,
+                window.dash_clientside.no_update];
+    }
+    if ("full" in found_segs_delta) {
+        return [found_segs_delta.full, found_segs_delta.render_id];
+    }
+    if (found_segs_delta.base != current_render_id) {
+        // the changes are not relative to the data we have, forget our render
+        // ID so that the server sends the next render in full
+        return [window.dash_clientside.no_update, null];
+    }
+    let found_segs_data_ = found_segs_data.map(view_slices => view_slices.slice());
+    found_segs_delta.changes.forEach(function (c) {
+        found_segs_data_[c[0]][c[1]] = c[2];
+    });
+    return [found_segs_data_, found_segs_delta.render_id];
+}
+
+// Replace the arrays of the traces of a figure that were sent as base64
+// encoded buffers (objects with "dtype" and "bdata", see
+// mesh_utils.encode_array) by typed arrays, which plotly.js renders directly.
+// returns a new figure, the one passed is not modified
+function decode_figure_arrays (figure) {
+    const array_types = {"float32": Float32Array, "int32": Int32Array};
+    figure = Object.assign({}, figure, {
+        data: figure.data.map(trace => Object.assign({}, trace))
+    });
+    figure.data.forEach(function (trace) {
+        Object.keys(trace).forEach(function (key) {
+            let v = trace[key];
+            if (v && (typeof v === "object") && ("bdata" in v)) {
+                const byte_chars = window.atob(v.bdata);
+                let bytes = new Uint8Array(byte_chars.length);
+                for (let n = 0; n < byte_chars.length; n++) {
+                    bytes[n] = byte_chars.charCodeAt(n);
+                }
+                trace[key] = new array_types[v.dtype](bytes.buffer);
+            }
+        });
+    });
+    return figure;
+}
+
+// Return what the server needs to bring its copy of the drawn shapes up to
+// date, and what to remember as sent.
+// Returns [shapes_delta, shapes_sent], where shapes_delta is an object
+// containing the version of the new shapes and either all the shapes in
+// "full" or, in "changes", an array of [view, slice, shapes] for the slices
+// whose shapes changed since the version "base". The shapes are sent in full
+// the first time and when the server asks for them (it didn't have the
+// version the changes were based on), see request_shapes_resync.
+function drawn_shapes_delta (
+    // the drawn shapes, see figure_display_update
+    drawn_shapes_data,
+    // an object containing the version and the shapes of the last shapes sent
+    shapes_sent,
+    // true to send all the shapes
+    resync) {
+    let version = shapes_sent.version + 1,
+        shapes_delta;
+    if (!shapes_sent.shapes || resync) {
+        shapes_delta = {version: version, base: null, full: drawn_shapes_data};
+    } else {
+        let changes = [];
+        drawn_shapes_data.forEach(function (view_shapes, j) {
+            view_shapes.forEach(function (shapes, i) {
+                let sent = shapes_sent.shapes[j][i];
+                if (JSON.stringify(shapes) != JSON.stringify(sent)) {
+                    changes.push([j, i, shapes]);
+                }
+            });
+        });
+        if (changes.length == 0) {
+            return [window.dash_clientside.no_update,
+                    window.dash_clientside.no_update];
+        }
+        shapes_delta = {version: version, base: shapes_sent.version,
+                        changes: changes};
+    }
+    return [shapes_delta, {version: version, shapes: drawn_shapes_data}];
+}
+
+// Make drawn_shapes_delta send all the shapes now, when the server asks for
+// them. The callbacks answering the server can't trigger it through an output
+// (that would make a cycle of callbacks), so the hidden button that is one of
+// its inputs is clicked instead.
+function request_shapes_resync () {
+    setTimeout(function () {
+        let button = document.getElementById("shapes-resync-button");
+        if (button) {
+            button.click();
+        }
+    }, 0);
+}
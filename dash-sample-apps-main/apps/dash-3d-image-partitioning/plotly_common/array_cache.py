@@ -0,0 +1,62 @@
+#plotly_common/array_cache.py
+
+import hashlib
+import os
+import uuid
+import numpy as np
+
+
+def array_cache_key(*arrays, **params):
+    """
+    Returns a key identifying the contents of the arrays and the parameters,
+    to name the results computed from them in an array cache.
+    """
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(repr((a.shape, a.dtype.str)).encode())
+        h.update(a.data)
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def _array_path(cache_dir, key, name):
+    return os.path.join(cache_dir, "%s-%s.npy" % (key, name))
+
+
+def write_atomically(path, write):
+    """
+    Makes the file at path by calling write(fp) on a file opened for writing
+    in binary mode, so that a reader never sees a partially written file: it
+    is written to a temporary file in the same directory, then renamed.
+    """
+    tmp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, "wb") as fp:
+            write(fp)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_or_compute_arrays(cache_dir, key, names, compute):
+    """
+    Returns a tuple of the arrays called names cached under key in cache_dir.
+    If they are not all there, compute() is called, which must return the
+    arrays in the order of names, and they are written to the cache.
+    The arrays are stored as uncompressed .npy files and returned
+    memory-mapped read-only, so loading them does not copy them and the pages
+    are shared by all the processes that load them.
+    """
+    paths = [_array_path(cache_dir, key, name) for name in names]
+    if not all(os.path.exists(p) for p in paths):
+        arrays = compute()
+        if len(arrays) != len(names):
+            raise ValueError(
+                "compute returned %d arrays for %d names" % (len(arrays), len(names))
+            )
+        os.makedirs(cache_dir, exist_ok=True)
+        for p, a in zip(paths, arrays):
+            write_atomically(p, lambda fp: np.save(fp, np.asarray(a)))
+    return tuple(np.load(p, mmap_mode="r") for p in paths)
@@ -0,0 +1,48 @@
+#plotly_common/case_registry.py
+
+import threading
+from plotly_common.lru import LRUCache
+
+
+class CaseRegistry:
+    """
+    Loads cases (a volume and everything derived from it) lazily by case ID,
+    calling load(case_id), and keeps the maxsize most recently used ones, so
+    that one server can serve many cases with the memory of a few. A case that
+    is evicted is dropped whole, with the caches it holds, and is loaded again
+    the next time it is requested.
+    While a case is being loaded, other threads requesting it wait for it
+    instead of loading it again. load must raise KeyError for unknown IDs.
+    """
+
+    def __init__(self, load, maxsize=4):
+        self._load = load
+        self._cases = LRUCache(maxsize)
+        # case ID -> lock held while that case is loaded
+        self._loading = dict()
+        self._lock = threading.Lock()
+
+    def get(self, case_id):
+        case = self._cases.get(case_id)
+        if case is not None:
+            return case
+        with self._lock:
+            loading = self._loading.setdefault(case_id, threading.Lock())
+        try:
+            with loading:
+                case = self._cases.get(case_id)
+                if case is None:
+                    case = self._load(case_id)
+                    self._cases.put(case_id, case)
+        finally:
+            with self._lock:
+                self._loading.pop(case_id, None)
+        return case
+
+    def evict(self, case_id):
+        """ Drops the case if it is loaded. """
+        self._cases.pop(case_id)
+
+    def loaded(self):
+        """ Returns the IDs of the loaded cases, least recently used first. """
+        return self._cases.keys()
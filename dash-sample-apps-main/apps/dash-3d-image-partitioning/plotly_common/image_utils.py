@@ -4,11 +4,41 @@ import plotly.express as px
 import numpy as np
 import itertools
 
+# number of labels converted to colors at a time by label_to_colors
+LUT_CHUNK_SIZE = 1 << 20
+
 
 def fromhex(n):
     return int(n, base=16)
 
 
+def label_colormap_lut(
+    n_labels,
+    colormap=px.colors.qualitative.Light24,
+    alpha=128,
+    color_class_offset=0,
+    no_map_zero=False,
+):
+    """
+    Returns an n_labels x 4 uint8 table whose row c is the RGBA color that
+    label_to_colors gives label c. See label_to_colors for the meaning of the
+    arguments.
+    """
+    colormap = [
+        tuple([fromhex(h[s : s + 2]) for s in range(0, len(h), 2)])
+        for h in [c.replace("#", "") for c in colormap]
+    ]
+    if type(alpha) is not type(list()):
+        alpha = [alpha]
+    palette = np.array(
+        [c + (a,) for c, a in zip(colormap, itertools.cycle(alpha))], dtype="uint8"
+    )
+    lut = palette[(np.arange(n_labels) + color_class_offset) % len(colormap)]
+    if no_map_zero and n_labels > 0:
+        lut[0] = 0
+    return lut
+
+
 def label_to_colors(
     img,
     colormap=px.colors.qualitative.Light24,
@@ -16,6 +46,7 @@ def label_to_colors(
     color_class_offset=0,
     labels_contiguous=False,
     no_map_zero=False,
+    out=None,
 ):
     """
     Take a tensor containing integers representing labels and return an dim0x...dim(D-1)x4
@@ -28,33 +59,45 @@ def label_to_colors(
     use of a particular range of colors in the colormap. This is useful for
     example if 0 means 'no class' but we want the color of class 1 to be
     colormap[0].
-    If labels in img are a contiguous set of integers, then, for speed,
-    labels_contiguous=True can be set and this will iterate from the smallest
-    through the greatest label, otherwise this iterates through the set of
-    labels as determined from img.
+    The colors are looked up in a table with a row per label (see
+    label_colormap_lut), so labels must be non-negative. labels_contiguous is
+    kept for compatibility and has no effect.
     if no_map_zero is True, then label 0 is not mapped (its items are left as
     [0,0,0,0] in the output)
+    If out is not None, it must be a uint8 array of the shape of the output and
+    the colors are written into it instead of a newly allocated array.
     """
-    colormap = [
-        tuple([fromhex(h[s : s + 2]) for s in range(0, len(h), 2)])
-        for h in [c.replace("#", "") for c in colormap]
-    ]
-    if type(alpha) is not type(list()):
-        alpha = [alpha]
-    cm_alpha = list(zip(colormap, itertools.cycle(alpha)))
-    cimg = np.zeros(img.shape + (3,), dtype="uint8")
-    alpha = np.zeros(img.shape + (1,), dtype="uint8")
-    if labels_contiguous:
-        labels = range(img.min(), img.max() + 1)
-    else:
-        labels = set(img.flatten())
-    for c in labels:
-        if (c == 0) and no_map_zero:
-            continue
-        cimg[img == c], alpha[img == c] = cm_alpha[
-            (c + color_class_offset) % len(colormap)
-        ]
-    return np.concatenate((cimg, alpha), axis=len(cimg.shape) - 1)
+    img = np.asarray(img)
+    n_labels = int(img.max()) + 1 if img.size > 0 else 1
+    if img.size > 0 and img.min() < 0:
+        raise ValueError("labels must be non-negative, got %s" % (img.min(),))
+    lut = label_colormap_lut(
+        n_labels,
+        colormap=colormap,
+        alpha=alpha,
+        color_class_offset=color_class_offset,
+        no_map_zero=no_map_zero,
+    )
+    if out is None:
+        out = np.empty(img.shape + (4,), dtype="uint8")
+    elif out.shape != img.shape + (4,) or not out.flags.c_contiguous:
+        raise ValueError(
+            "out must be a contiguous array of shape %s" % (img.shape + (4,),)
+        )
+    flat_img = img.reshape(-1)
+    flat_out = out.reshape((-1, 4))
+    # the gather is done in chunks so that the labels converted to indices
+    # never take more memory than a chunk. The labels have been checked to be
+    # in range, so clip mode avoids the buffering take does in raise mode.
+    for b in range(0, flat_img.size, LUT_CHUNK_SIZE):
+        np.take(
+            lut,
+            flat_img[b : b + LUT_CHUNK_SIZE],
+            axis=0,
+            out=flat_out[b : b + LUT_CHUNK_SIZE],
+            mode="clip",
+        )
+    return out
 
 
 def combine_last_dim(
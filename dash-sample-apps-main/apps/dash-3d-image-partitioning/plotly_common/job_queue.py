@@ -0,0 +1,78 @@
+#plotly_common/job_queue.py
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+
+
+class JobQueue:
+    """
+    Runs jobs in a pool of max_workers worker processes, at most one per key,
+    in the order they are submitted. A job for key calls
+    run(key, progress, *args) in a worker, where progress is a dict shared
+    with this process in which the job can report how far it got by setting
+    progress[key] = (done, total, message).
+    Worker processes are forked where possible, so run can be any function of
+    an imported module. The pool is only started when the first job is
+    submitted.
+    """
+
+    def __init__(self, run, max_workers=1):
+        self._run = run
+        self.max_workers = max_workers
+        self._executor = None
+        self._progress = None
+        # key -> future
+        self._jobs = dict()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+        if self._progress is None:
+            self._progress = context.Manager().dict()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=context
+        )
+
+    def submit(self, key, *args):
+        """ Queues a job for key, unless one is queued, running or done (a
+        failed job is submitted again). """
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is not None and not (future.done() and future.exception()):
+                return
+            if self._executor is None:
+                self._start()
+            self._progress[key] = (0, 0, "queued")
+            try:
+                future = self._executor.submit(self._run, key, self._progress, *args)
+            except BrokenProcessPool:
+                # a worker process died (e.g. killed for lack of memory), which
+                # fails all the jobs of the pool, so a new pool is started
+                self._executor.shutdown(wait=False)
+                self._start()
+                future = self._executor.submit(self._run, key, self._progress, *args)
+            self._jobs[key] = future
+
+    def status(self, key):
+        """
+        Returns the state of the job for key, as a dict with "state" (one of
+        "unknown", "queued", "running", "done" and "failed") and the last
+        "progress" it reported, as (done, total, message).
+        """
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is None:
+                return dict(state="unknown", progress=(0, 0, ""))
+            progress = tuple(self._progress.get(key, (0, 0, "")))
+        if future.done():
+            if future.exception() is not None:
+                return dict(state="failed", progress=progress)
+            return dict(state="done", progress=progress)
+        return dict(
+            state="running" if future.running() else "queued", progress=progress
+        )
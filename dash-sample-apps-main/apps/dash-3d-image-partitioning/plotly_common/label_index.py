@@ -0,0 +1,73 @@
+#plotly_common/label_index.py
+
+import numpy as np
+
+
+class LabelIndex:
+    """
+    Maps each label of an integer tensor to the voxels carrying that label.
+    The index is stored CSR-style: the flat indices (into the raveled tensor)
+    of the voxels with label l are flat_indices[offsets[l]:offsets[l+1]].
+    Building the index costs one sort of the tensor, after that looking up the
+    voxels of a set of labels only costs the number of voxels returned, rather
+    than a full scan of the tensor per label.
+    Labels must be non-negative integers.
+    """
+
+    def __init__(self, labels):
+        self.shape = labels.shape
+        flat = labels.ravel()
+        counts = np.bincount(flat)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        # a stable sort keeps the voxels of each label in raster order
+        index_dtype = np.int32 if flat.size < np.iinfo(np.int32).max else np.int64
+        self.flat_indices = np.argsort(flat, kind="stable").astype(index_dtype)
+
+    @classmethod
+    def from_arrays(cls, shape, offsets, flat_indices):
+        """
+        Returns the index of a tensor of the given shape from the offsets and
+        flat_indices of an index built before (e.g., stored in an array cache),
+        without sorting the tensor again.
+        """
+        index = cls.__new__(cls)
+        index.shape = tuple(shape)
+        index.offsets = offsets
+        index.flat_indices = flat_indices
+        return index
+
+    @property
+    def n_labels(self):
+        """ The number of label slots (the greatest label + 1). """
+        return len(self.offsets) - 1
+
+    def voxels(self, labels):
+        """
+        Returns the flat indices of all the voxels whose label is in labels.
+        Labels not present in the indexed tensor are ignored.
+        """
+        ranges = [
+            (self.offsets[l], self.offsets[l + 1])
+            for l in labels
+            if 0 <= l < self.n_labels
+        ]
+        if len(ranges) == 0:
+            return np.zeros(0, dtype=self.flat_indices.dtype)
+        return np.concatenate([self.flat_indices[b:e] for b, e in ranges])
+
+    def coords(self, labels):
+        """
+        Returns the coordinates of all the voxels whose label is in labels, as
+        an array with a row per voxel and a column per dimension.
+        """
+        return np.stack(np.unravel_index(self.voxels(labels), self.shape), axis=1)
+
+    def mask(self, labels, dtype="uint8", value=1):
+        """
+        Returns a tensor of the indexed tensor's shape that is value where the
+        label is in labels and 0 elsewhere.
+        """
+        out = np.zeros(self.shape, dtype=dtype)
+        out.reshape(-1)[self.voxels(labels)] = value
+        return out
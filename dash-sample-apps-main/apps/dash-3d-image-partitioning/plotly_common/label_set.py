@@ -0,0 +1,99 @@
+#plotly_common/label_set.py
+
+import base64
+import numpy as np
+
+
+class LabelSet:
+    """
+    A set of labels in [0, n_labels), stored as a bitmap of n_labels bits, so
+    that a selection of superpixels takes a few hundred bits whatever the size
+    of the volume. Whatever is shown of a selection (the volume of the selected
+    voxels, its slices, its mesh) is derived from the labels when needed, see
+    LabelIndex.mask.
+    LabelSets are immutable, the operators return new sets. Labels outside
+    [0, n_labels) are ignored.
+    """
+
+    def __init__(self, n_labels, labels=()):
+        labels = np.fromiter((int(l) for l in labels), dtype=np.int64)
+        mask = np.zeros(n_labels, dtype=bool)
+        mask[labels[(labels >= 0) & (labels < n_labels)]] = True
+        self.n_labels = n_labels
+        self.bits = np.packbits(mask, bitorder="little")
+
+    def mask(self):
+        """ Returns a boolean array of n_labels that is true at the labels in
+        the set, which can be indexed by a label tensor. """
+        return np.unpackbits(self.bits, count=self.n_labels, bitorder="little").astype(
+            bool
+        )
+
+    def labels(self):
+        """ Returns the labels in the set as a sorted integer array. """
+        return np.flatnonzero(self.mask())
+
+    def encode(self):
+        """ Returns the bitmap as a URL-safe string, see decode. """
+        return base64.urlsafe_b64encode(self.bits.tobytes()).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, n_labels, s):
+        """ Returns the set of n_labels labels encoded as s by encode. Raises
+        ValueError if s is not such an encoding. """
+        try:
+            data = base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+        except (TypeError, ValueError):
+            raise ValueError("bad label set encoding")
+        if len(data) != (n_labels + 7) // 8:
+            raise ValueError("bad label set encoding")
+        label_set = cls.__new__(cls)
+        label_set.n_labels = n_labels
+        label_set.bits = np.frombuffer(data, dtype=np.uint8).copy()
+        # the padding bits of the last byte are not labels
+        if n_labels % 8 > 0:
+            label_set.bits[-1] &= (1 << (n_labels % 8)) - 1
+        return label_set
+
+    def _combine(self, other, op):
+        if not isinstance(other, LabelSet):
+            other = LabelSet(self.n_labels, other)
+        if other.n_labels != self.n_labels:
+            raise ValueError("label sets of different numbers of labels")
+        label_set = LabelSet.__new__(LabelSet)
+        label_set.n_labels = self.n_labels
+        label_set.bits = op(self.bits, other.bits)
+        return label_set
+
+    def __or__(self, other):
+        return self._combine(other, np.bitwise_or)
+
+    def __and__(self, other):
+        return self._combine(other, np.bitwise_and)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def __contains__(self, label):
+        return 0 <= label < self.n_labels and bool(
+            (self.bits[label >> 3] >> (label & 7)) & 1
+        )
+
+    def __iter__(self):
+        return iter(self.labels().tolist())
+
+    def __len__(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, LabelSet)
+            and self.n_labels == other.n_labels
+            and np.array_equal(self.bits, other.bits)
+        )
+
+    def __hash__(self):
+        return hash((self.n_labels, self.bits.tobytes()))
+
+    def __repr__(self):
+        return "LabelSet(%d, %r)" % (self.n_labels, self.labels().tolist())
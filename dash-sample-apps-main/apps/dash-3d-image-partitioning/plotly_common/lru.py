@@ -0,0 +1,48 @@
+#plotly_common/lru.py
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    A mapping that keeps at most maxsize items, discarding the least recently
+    used ones when it is full. Reading or writing an item makes it the most
+    recently used. Safe to use from several threads.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def keys(self):
+        """ Returns a list of the keys, least recently used first. """
+        with self._lock:
+            return list(self._items.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
@@ -0,0 +1,231 @@
+#plotly_common/mesh_utils.py
+
+import base64
+import threading
+import warnings
+import numpy as np
+from skimage import measure
+
+try:
+    # optional, only needed to simplify meshes
+    import pyfqmr
+except ImportError:
+    pyfqmr = None
+
+
+def volume_mesh(volume, level=0, step_size=3):
+    """
+    Returns the (verts, faces) of the isosurface at level of volume, computed by
+    marching cubes. If there is no such surface, both are empty.
+    """
+    try:
+        verts, faces, _, _ = measure.marching_cubes(volume, level, step_size=step_size)
+    except RuntimeError:
+        return (np.zeros((0, 3), dtype="float32"), np.zeros((0, 3), dtype="int32"))
+    return (verts.astype("float32"), faces.astype("int32"))
+
+
+def decimation_target(target_faces):
+    """
+    Returns the number of faces decimate_mesh really simplifies meshes to when
+    asked for target_faces: target_faces, or 0 (no simplification) if pyfqmr
+    is not installed, which is warned about. Results cached by the number of
+    faces should be keyed by this number.
+    """
+    if pyfqmr is None and target_faces > 0:
+        warnings.warn(
+            "pyfqmr is not installed, the meshes are not simplified to %d faces"
+            % (target_faces,)
+        )
+        return 0
+    return target_faces
+
+
+def decimate_mesh(verts, faces, target_faces):
+    """
+    Simplifies the mesh to about target_faces faces by quadric edge collapse.
+    This needs the pyfqmr package: if it is not installed, or the mesh already
+    has no more than target_faces faces, the mesh is returned unchanged.
+    """
+    if pyfqmr is None or target_faces <= 0 or len(faces) <= target_faces:
+        return (verts, faces)
+    simplifier = pyfqmr.Simplify()
+    simplifier.setMesh(np.asarray(verts, dtype="float64"), np.asarray(faces))
+    simplifier.simplify_mesh(target_count=target_faces, verbose=0)
+    verts, faces, _ = simplifier.getMesh()
+    return (verts.astype("float32"), faces.astype("int32"))
+
+
+def encode_array(a, dtype):
+    """
+    Returns the array converted to dtype ("float32" or "int32") as a dict
+    holding the base64 encoding of its little-endian bytes in "bdata" and its
+    type in "dtype", which is much smaller and faster to serialize than a list
+    of numbers. See decode_figure_arrays in assets/app_clientside.js.
+    """
+    a = np.ascontiguousarray(a, dtype=np.dtype(dtype).newbyteorder("<"))
+    return dict(dtype=dtype, bdata=base64.b64encode(a.data).decode())
+
+
+def mesh_to_trace(verts, faces, binary=False, **kwargs):
+    """
+    Returns the Mesh3d trace of the mesh as a dict, ready to be put in a
+    figure's data without further validation or conversion. The coordinates
+    and indices are lists, or if binary is True, base64 encoded buffers (see
+    encode_array). kwargs are added to the trace's attributes.
+    """
+    x, y, z = np.asarray(verts).T
+    i, j, k = np.asarray(faces).T
+    if binary:
+        coords = [encode_array(c, "float32") for c in [x, y, z]]
+        indices = [encode_array(c, "int32") for c in [i, j, k]]
+    else:
+        coords = [c.tolist() for c in [x, y, z]]
+        indices = [c.tolist() for c in [i, j, k]]
+    return dict(
+        type="mesh3d",
+        x=coords[0],
+        y=coords[1],
+        z=coords[2],
+        i=indices[0],
+        j=indices[1],
+        k=indices[2],
+        **kwargs
+    )
+
+
+def concatenate_meshes(meshes):
+    """ Returns the (verts, faces) of a single mesh made of the (verts, faces)
+    meshes. """
+    meshes = list(meshes)
+    if len(meshes) == 0:
+        return (np.zeros((0, 3), dtype="float32"), np.zeros((0, 3), dtype="int32"))
+    offsets = np.cumsum([0] + [len(v) for v, _ in meshes[:-1]])
+    verts = np.concatenate([v for v, _ in meshes]).astype("float32", copy=False)
+    faces = np.concatenate([f + o for (_, f), o in zip(meshes, offsets)])
+    return (verts, faces.astype("int32", copy=False))
+
+
+class LabelMeshCache:
+    """
+    Computes and caches a surface mesh for each label of a label tensor, so
+    that the mesh of a selection of labels is the concatenation of the cached
+    meshes of the labels selected, and adding a label to a selection only
+    meshes that label, if it has not been meshed before.
+    Each label is meshed by marching cubes over the bounding box of its voxels
+    (found through label_index, see LabelIndex, or read from stats, a
+    SuperpixelStats of the same labels, if given) plus margin, on the same grid
+    of step_size as marching cubes over the whole volume would use, and the
+    vertices are offset back into volume coordinates.
+    The meshes are in the coordinates of the label tensor with its axes
+    permuted by transpose and then the axes in flip reversed, like
+    labels.transpose(transpose)[..., ::-1] for flip=(2,) and 3 dimensions.
+    """
+
+    def __init__(
+        self, label_index, step_size=3, margin=None, transpose=None, flip=(), stats=None
+    ):
+        self.label_index = label_index
+        self.stats = stats
+        self.step_size = step_size
+        # the surface is only closed if at least a sample beyond the label is 0
+        self.margin = step_size if margin is None else margin
+        ndim = len(label_index.shape)
+        self.transpose = tuple(range(ndim)) if transpose is None else tuple(transpose)
+        self.flip = tuple(flip)
+        self.shape = np.array([label_index.shape[a] for a in self.transpose])
+        self._meshes = dict()
+        self._lock = threading.Lock()
+
+    def _label_coords(self, label):
+        coords = self.label_index.coords([label])[:, self.transpose]
+        for a in self.flip:
+            coords[:, a] = self.shape[a] - 1 - coords[:, a]
+        return coords
+
+    def compute_label_mesh(self, label):
+        """ Returns the (verts, faces) of the surface of the label's voxels. """
+        coords = self._label_coords(label)
+        if len(coords) == 0:
+            return concatenate_meshes([])
+        if self.stats is not None:
+            low = self.stats.start[label][list(self.transpose)]
+            high = self.stats.stop[label][list(self.transpose)] - 1
+            for a in self.flip:
+                low[a], high[a] = (
+                    self.shape[a] - 1 - high[a],
+                    self.shape[a] - 1 - low[a],
+                )
+        else:
+            low, high = coords.min(axis=0), coords.max(axis=0)
+        # align the start of the box with the grid of marching cubes over the
+        # whole volume
+        start = np.maximum(low - self.margin, 0)
+        start -= start % self.step_size
+        stop = np.minimum(high + self.margin + 1, self.shape)
+        box = np.zeros(stop - start, dtype="uint8")
+        box[tuple((coords - start).T)] = 1
+        verts, faces = volume_mesh(box, 0, step_size=self.step_size)
+        return (verts + start.astype("float32"), faces)
+
+    def label_mesh(self, label):
+        with self._lock:
+            mesh = self._meshes.get(label)
+        if mesh is None:
+            mesh = self.compute_label_mesh(label)
+            with self._lock:
+                self._meshes[label] = mesh
+        return mesh
+
+    def mesh(self, labels):
+        """ Returns the (verts, faces) of the surfaces of the labels. """
+        return concatenate_meshes([self.label_mesh(l) for l in sorted(labels)])
+
+
+def pack_label_meshes(label_meshes, n_labels):
+    """
+    Meshes the labels 0 to n_labels-1 with label_meshes (a LabelMeshCache) and
+    returns them packed in 4 arrays: (verts, faces, vert_offsets,
+    face_offsets), where the mesh of label l has the vertices
+    verts[vert_offsets[l]:vert_offsets[l+1]] and the faces
+    faces[face_offsets[l]:face_offsets[l+1]], which index those vertices
+    starting from 0. See PackedMeshes.
+    """
+    meshes = [label_meshes.compute_label_mesh(l) for l in range(n_labels)]
+    vert_offsets = np.cumsum([0] + [len(v) for v, _ in meshes])
+    face_offsets = np.cumsum([0] + [len(f) for _, f in meshes])
+    verts, _ = concatenate_meshes([(v, f[:0]) for v, f in meshes])
+    faces = np.concatenate([f for _, f in meshes] + [np.zeros((0, 3), dtype="int32")])
+    return (verts, faces.astype("int32"), vert_offsets, face_offsets)
+
+
+class PackedMeshes:
+    """
+    The meshes of all the labels of a label tensor, packed in 4 arrays as
+    returned by pack_label_meshes, so they can be precomputed once and stored.
+    Getting the mesh of a selection of labels only concatenates parts of
+    these arrays.
+    """
+
+    def __init__(self, verts, faces, vert_offsets, face_offsets):
+        self.verts = verts
+        self.faces = faces
+        self.vert_offsets = vert_offsets
+        self.face_offsets = face_offsets
+
+    @property
+    def n_labels(self):
+        return len(self.vert_offsets) - 1
+
+    def label_mesh(self, label):
+        vo, fo = self.vert_offsets, self.face_offsets
+        return (
+            self.verts[vo[label] : vo[label + 1]],
+            self.faces[fo[label] : fo[label + 1]],
+        )
+
+    def mesh(self, labels):
+        """ Returns the (verts, faces) of the surfaces of the labels. """
+        return concatenate_meshes(
+            [self.label_mesh(l) for l in sorted(labels) if 0 <= l < self.n_labels]
+        )
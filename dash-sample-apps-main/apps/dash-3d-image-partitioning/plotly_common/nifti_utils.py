@@ -0,0 +1,61 @@
+#plotly_common/nifti_utils.py
+
+import zlib
+import nibabel as nib
+import numpy as np
+from skimage import img_as_ubyte
+
+
+def load_nifti_ubyte(path, chunk_size=16):
+    """
+    Loads the 3D NIfTI image at path as a uint8 volume normalized so that its
+    minimum maps to 0 and its maximum to 255, with the last axis of the image
+    moved first and reversed (so that the first axis indexes the top view
+    slices, from the top).
+    The image is memory-mapped when it is not compressed and is read chunk_size
+    slices (along its last axis) at a time, so apart from the returned volume
+    only a chunk is ever held in memory, as float.
+    """
+    proxy = nib.load(path, mmap=True).dataobj
+    n = proxy.shape[2]
+    chunks = [(z0, min(z0 + chunk_size, n)) for z0 in range(0, n, chunk_size)]
+    vmin, vmax = np.inf, -np.inf
+    for z0, z1 in chunks:
+        chunk = np.asanyarray(proxy[:, :, z0:z1])
+        vmin, vmax = min(vmin, chunk.min()), max(vmax, chunk.max())
+    vmin, vmax = float(vmin), float(vmax)
+    out = np.empty((n,) + tuple(proxy.shape[:2]), dtype=np.uint8)
+    for z0, z1 in chunks:
+        chunk = np.asanyarray(proxy[:, :, z0:z1]).transpose(2, 0, 1)[::-1]
+        chunk = (chunk.astype("float") - vmin) / (vmax - vmin)
+        out[n - z1 : n - z0] = img_as_ubyte(chunk)
+    return out
+
+
+# the offset of the data in a single file NIfTI-1 image: the 348 bytes of the
+# header followed by 4 bytes saying there are no extensions
+NIFTI_VOX_OFFSET = 352
+
+
+def stream_nifti_gz(shape, dtype, chunks, compresslevel=6):
+    """
+    Yields the bytes of a gzipped single file NIfTI-1 image (.nii.gz) of the
+    given shape and dtype, without ever holding the whole image.
+    chunks must yield arrays whose bytes, in C order and one after the other,
+    are the image's data in the Fortran (first axis fastest) order of NIfTI,
+    e.g. the slices along the first axis of the image transposed.
+    """
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header["vox_offset"] = NIFTI_VOX_OFFSET
+    # 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = compressor.compress(header.binaryblock + b"\0" * 4)
+    for chunk in chunks:
+        chunk = np.ascontiguousarray(chunk, dtype=dtype)
+        data += compressor.compress(chunk.data)
+        if len(data) > 0:
+            yield data
+            data = b""
+    yield data + compressor.flush()
@@ -202,3 +202,18 @@ def img_array_to_mime_bytes(img_array):
     typ, cont = contents.split(",")
     byt = base64.b64decode(cont)
     return (mime, byt)
+
+
+def array_to_png_bytes(img_array):
+    """
+    Encodes an array of type uint8 (with dimensions (height,width) or
+    (height,width,number_of_color_channels)) as PNG, without converting its
+    values, and returns the bytes of the PNG file.
+    """
+    buf = io.BytesIO()
+    PIL.Image.fromarray(np.ascontiguousarray(img_array)).save(buf, format="png")
+    return buf.getvalue()
+
+
+def png_bytes_to_uri(png):
+    return "data:image/png;base64," + base64.b64encode(png).decode()
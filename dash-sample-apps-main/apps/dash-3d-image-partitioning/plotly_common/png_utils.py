@@ -0,0 +1,115 @@
+#plotly_common/png_utils.py
+
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# the zlib compression level used when none is given
+DEFAULT_COMPRESSLEVEL = 6
+
+# the scanline buffers are kept per thread, see _scanline_buffer
+_buffers = threading.local()
+
+
+def hex_to_rgb(color):
+    """ Returns the (r, g, b) of a color given as "#rrggbb". """
+    return tuple(int(color[i : i + 2], 16) for i in (1, 3, 5))
+
+
+def _chunk(chunk_type, data):
+    return b"".join(
+        [
+            struct.pack(">I", len(data)),
+            chunk_type,
+            data,
+            struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF),
+        ]
+    )
+
+
+def _scanline_buffer(height, row_bytes):
+    # the filtered image data (a filter type byte then the row) reuses the
+    # buffer of the thread as long as it is big enough
+    size = height * (row_bytes + 1)
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = np.empty(size, dtype="uint8")
+        _buffers.buf = buf
+    return buf[:size].reshape((height, row_bytes + 1))
+
+
+def palette_bit_depth(n_colors):
+    """ The smallest bit depth of a palette PNG with n_colors colors. """
+    for bit_depth in (1, 2, 4):
+        if n_colors <= 1 << bit_depth:
+            return bit_depth
+    return 8
+
+
+def palette_png_bytes(indices, colors, alpha=None, compresslevel=None):
+    """
+    Encodes a (height,width) array of indices into colors, a list of "#rrggbb"
+    or (r, g, b), as a palette PNG and returns the bytes of the PNG file.
+    alpha, if given, is the opacity (0 to 255) of each color, written as a tRNS
+    chunk. The pixels take the fewest bits allowed for the number of colors
+    (1 bit for 2 colors), so an overlay of a couple of colors is many times
+    smaller and faster to encode than the same image as RGBA.
+    compresslevel is the zlib level, 0 (none, fastest) to 9 (smallest).
+    Indices must be smaller than the number of colors.
+    """
+    indices = np.asarray(indices)
+    height, width = indices.shape
+    colors = [hex_to_rgb(c) if isinstance(c, str) else tuple(c) for c in colors]
+    bit_depth = palette_bit_depth(len(colors))
+    if bit_depth == 8:
+        rows = indices.astype("uint8", copy=False)
+    else:
+        # pack the pixels of each row, most significant bits first
+        per_byte = 8 // bit_depth
+        row_bytes = -(-width // per_byte)
+        padded = np.zeros((height, row_bytes * per_byte), dtype="uint8")
+        padded[:, :width] = indices
+        shifts = np.arange(per_byte - 1, -1, -1, dtype="uint8") * bit_depth
+        rows = np.bitwise_or.reduce(
+            padded.reshape((height, row_bytes, per_byte)) << shifts, axis=2
+        ).astype("uint8")
+    scanlines = _scanline_buffer(height, rows.shape[1])
+    # filter type 0 (none) on every row
+    scanlines[:, 0] = 0
+    scanlines[:, 1:] = rows
+    level = DEFAULT_COMPRESSLEVEL if compresslevel is None else compresslevel
+    chunks = [
+        PNG_SIGNATURE,
+        _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, 3, 0, 0, 0)),
+        _chunk(b"PLTE", bytes(v for c in colors for v in c)),
+    ]
+    if alpha is not None:
+        # trailing opaque entries can be left out of tRNS
+        alpha = list(alpha)
+        while len(alpha) > 0 and alpha[-1] == 255:
+            alpha.pop()
+        if len(alpha) > 0:
+            chunks.append(_chunk(b"tRNS", bytes(alpha)))
+    # zlib releases the GIL while compressing, see palette_pngs_bytes
+    chunks.append(_chunk(b"IDAT", zlib.compress(scanlines.data, level)))
+    chunks.append(_chunk(b"IEND", b""))
+    return b"".join(chunks)
+
+
+def palette_pngs_bytes(
+    slices, colors, alpha=None, compresslevel=None, max_workers=None
+):
+    """
+    Encodes each array of indices in slices like palette_png_bytes, in a pool of
+    max_workers threads (which run in parallel as zlib releases the GIL), and
+    returns the list of the bytes of the PNG files.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(
+            executor.map(
+                lambda s: palette_png_bytes(s, colors, alpha, compresslevel), slices
+            )
+        )
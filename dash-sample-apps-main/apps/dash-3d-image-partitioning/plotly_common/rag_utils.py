@@ -0,0 +1,137 @@
+#plotly_common/rag_utils.py
+
+from collections import deque
+import heapq
+import numpy as np
+from skimage.future import graph
+
+
+def superpixel_rag(labels, stats, background=0):
+    """
+    Returns the region adjacency graph of the superpixels in the label tensor,
+    as a skimage RAG. Two superpixels are adjacent if they have voxels that are
+    neighbours along one of the axes. Each node has the "mean intensity" and
+    "pixel count" of the superpixel's voxels, read from stats (see
+    SuperpixelStats), and each edge has as "weight" the absolute difference of
+    the mean intensities of its nodes.
+    The background label is left out of the graph.
+    """
+    pairs = []
+    for axis in range(labels.ndim):
+        n = labels.shape[axis]
+        a = np.take(labels, range(0, n - 1), axis=axis).ravel()
+        b = np.take(labels, range(1, n), axis=axis).ravel()
+        touching = (a != b) & (a != background) & (b != background)
+        a, b = a[touching], b[touching]
+        pairs.append(np.unique(np.stack((np.minimum(a, b), np.maximum(a, b))), axis=1))
+    pairs = np.unique(np.concatenate(pairs, axis=1), axis=1)
+    rag = graph.RAG()
+    for l in np.flatnonzero(stats.count):
+        if l == background:
+            continue
+        rag.add_node(
+            int(l),
+            **{"mean intensity": stats.mean[l], "pixel count": int(stats.count[l])}
+        )
+    for a, b in pairs.T:
+        a, b = int(a), int(b)
+        weight = abs(rag.nodes[a]["mean intensity"] - rag.nodes[b]["mean intensity"])
+        rag.add_edge(a, b, weight=weight)
+    return rag
+
+
+def grow_selection(rag, selected, tolerance):
+    """
+    Returns the set of selected superpixels grown through the region adjacency
+    graph: starting from the selected nodes, neighbours whose mean intensity is
+    within tolerance of the mean intensity of the selection (over all its
+    voxels) are added, and the growing continues from them.
+    Selected labels that are not nodes of the graph are kept but not grown
+    from.
+    """
+    selected = set(selected)
+    seeds = [l for l in selected if l in rag]
+    if len(seeds) == 0:
+        return selected
+    counts = np.array([rag.nodes[l]["pixel count"] for l in seeds])
+    means = np.array([rag.nodes[l]["mean intensity"] for l in seeds])
+    selection_mean = np.sum(counts * means) / np.sum(counts)
+    grown = set(selected)
+    queue = deque(seeds)
+    while len(queue) > 0:
+        for n in rag.neighbors(queue.popleft()):
+            if n in grown:
+                continue
+            if abs(rag.nodes[n]["mean intensity"] - selection_mean) <= tolerance:
+                grown.add(n)
+                queue.append(n)
+    return grown
+
+
+def rag_hierarchy(rag, n_labels, level_sizes):
+    """
+    Merges the nodes of the region adjacency graph agglomeratively, always
+    merging the two adjacent regions whose mean intensities are closest, and
+    records the partition when the number of regions reaches each of
+    level_sizes (in decreasing order).
+    Returns an integer array with a row per level and a column per label in
+    [0, n_labels): row 0 maps each label to itself and row k maps each label to
+    the label representing its region at level k. Labels that are not nodes of
+    the graph (like the background) always map to themselves.
+    """
+    parent = np.arange(n_labels)
+    counts = np.zeros(n_labels)
+    means = np.zeros(n_labels)
+    neighbours = dict()
+    for n, d in rag.nodes(data=True):
+        counts[n] = d["pixel count"]
+        means[n] = d["mean intensity"]
+        neighbours[n] = set(rag.neighbors(n))
+    heap = [(abs(means[a] - means[b]), a, b) for a, b in rag.edges()]
+    heapq.heapify(heap)
+    levels = [parent.copy()]
+    n_regions = len(neighbours)
+    for size in sorted(level_sizes, reverse=True):
+        while n_regions > size and len(heap) > 0:
+            w, a, b = heapq.heappop(heap)
+            if parent[a] != a or parent[b] != b:
+                # one of the regions was merged into another since
+                continue
+            if w != abs(means[a] - means[b]):
+                # a region grew since, its edges were pushed again
+                continue
+            if counts[a] < counts[b]:
+                a, b = b, a
+            parent[b] = a
+            means[a] = (means[a] * counts[a] + means[b] * counts[b]) / (
+                counts[a] + counts[b]
+            )
+            counts[a] += counts[b]
+            neighbours[a] |= neighbours.pop(b)
+            neighbours[a] -= {a, b}
+            for n in neighbours[a]:
+                neighbours[n].discard(b)
+                neighbours[n].add(a)
+                heapq.heappush(heap, (abs(means[a] - means[n]), a, n))
+            n_regions -= 1
+        level = np.array([_find(parent, l) for l in range(n_labels)])
+        levels.append(level)
+    return np.stack(levels)
+
+
+def _find(parent, a):
+    while parent[a] != a:
+        a = parent[a]
+    return a
+
+
+def level_members(levels, level, labels):
+    """
+    Returns the set of labels (of level 0) making up the regions at the given
+    level that contain any of labels.
+    """
+    labels = [l for l in labels if 0 <= l < levels.shape[1]]
+    if level == 0 or len(labels) == 0:
+        return set(labels)
+    regions = levels[level][labels]
+    return set(np.flatnonzero(np.isin(levels[level], regions)).tolist())
@@ -0,0 +1,148 @@
+#plotly_common/session_store.py
+
+import contextlib
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import uuid
+from plotly_common.array_cache import write_atomically
+from plotly_common.lru import LRUCache
+
+try:
+    # only on Unix, elsewhere the sessions are only locked within a process
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# session IDs are used in file names, so only hexadecimal IDs are accepted
+_SESSION_ID = re.compile(r"^[0-9a-f]{8,64}$")
+# a session file starts with the version of the state it holds, so a process
+# can tell whether its copy is up to date by reading a few bytes
+_VERSION = struct.Struct("<Q")
+# the session files are pruned at most this often (in seconds)
+_PRUNE_INTERVAL = 3600
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class SessionStore:
+    """
+    Keeps the server-side state of the sessions by session ID (see
+    new_session_id): the maxsize most recently used ones in memory and, if a
+    directory is given, all of them pickled in that directory, so that they
+    outlive their eviction from memory and restarts of the server and are
+    shared by the server processes. A state read from memory is checked
+    against the version in its file, so the changes made by other processes
+    are seen. A state that is changed must be read, changed and stored under
+    the session's lock (see lock), so that concurrent changes are not lost.
+    If max_age is given, the files of the sessions not stored for max_age
+    seconds are removed when the store is made and then from time to time.
+    The states must be picklable if a directory is given.
+    """
+
+    def __init__(self, maxsize=256, directory=None, max_age=None):
+        self.directory = directory
+        self.max_age = max_age
+        # session ID -> (state, version of its file when read)
+        self._states = LRUCache(maxsize)
+        # without a directory, the sessions are locked by the lock at the hash
+        # of their ID, so the number of locks doesn't grow with the sessions
+        self._locks = [threading.Lock() for _ in range(64)]
+        self._next_prune = 0
+        self.prune()
+
+    def _path(self, session_id, extension=".pickle"):
+        if not _SESSION_ID.match(session_id):
+            raise KeyError("bad session ID %s" % (session_id,))
+        return os.path.join(self.directory, session_id + extension)
+
+    @contextlib.contextmanager
+    def lock(self, session_id):
+        """
+        Holds the lock of the session for the duration of the with block. With
+        a directory, the lock is an flock of a file next to the state's, so it
+        is held against the other processes as well.
+        """
+        if self.directory is None or fcntl is None:
+            with self._locks[hash(session_id) % len(self._locks)]:
+                yield
+            return
+        path = self._path(session_id, ".lock")
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, "a") as fp:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+            try:
+                # the lock files of sessions in use are not pruned
+                os.utime(fp.fileno())
+                yield
+            finally:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def get(self, session_id, default=None):
+        """ Returns the state of the session, or default if there is none. """
+        entry = self._states.get(session_id)
+        if self.directory is None:
+            return default if entry is None else entry[0]
+        try:
+            fp = open(self._path(session_id), "rb")
+        except FileNotFoundError:
+            return default if entry is None else entry[0]
+        with fp:
+            (version,) = _VERSION.unpack(fp.read(_VERSION.size))
+            if entry is not None and entry[1] == version:
+                return entry[0]
+            state = pickle.load(fp)
+        self._states.put(session_id, (state, version))
+        return state
+
+    def put(self, session_id, state):
+        """ Stores the state of the session (call again after changing it). """
+        version = None
+        if self.directory is not None:
+            path = self._path(session_id)
+            try:
+                with open(path, "rb") as fp:
+                    (version,) = _VERSION.unpack(fp.read(_VERSION.size))
+            except FileNotFoundError:
+                version = 0
+            version += 1
+            os.makedirs(self.directory, exist_ok=True)
+
+            def write(fp):
+                fp.write(_VERSION.pack(version))
+                pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+            # readers never see a partially written state
+            write_atomically(path, write)
+        self._states.put(session_id, (state, version))
+        if time.time() >= self._next_prune:
+            self.prune()
+
+    def prune(self):
+        """
+        Removes the files of the sessions that were not stored for max_age
+        seconds (and the files left by interrupted writes), if there is a
+        directory and a max_age.
+        """
+        if self.directory is None or self.max_age is None:
+            return
+        now = time.time()
+        self._next_prune = now + min(self.max_age, _PRUNE_INTERVAL)
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.endswith((".pickle", ".lock", ".tmp")):
+                continue
+            try:
+                if entry.stat().st_mtime < now - self.max_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # removed by another process
+                pass
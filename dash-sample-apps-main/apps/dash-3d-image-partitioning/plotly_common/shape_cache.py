@@ -0,0 +1,90 @@
+#plotly_common/shape_cache.py
+
+import threading
+
+
+class SliceShapeCache:
+    """
+    Remembers, for each (view, slice) pair, the shapes that were last
+    rasterized there and the set of labels found beneath their mask, so that
+    when the drawn shapes change only the slices whose shape lists differ from
+    the last render need to be rasterized again.
+    The masks themselves are only kept if keep_masks is True, and are never
+    pickled (they are made again by the next update), so a pickled cache only
+    holds the shapes and a few labels per slice.
+    The shape data is in the format of the drawn-shapes store: a list (one
+    entry per view) of lists (one entry per slice) of lists of shapes.
+    """
+
+    def __init__(self, keep_masks=False):
+        self.keep_masks = keep_masks
+        # (view, slice) -> (shapes, labels)
+        self._entries = dict()
+        # (view, slice) -> mask, if keep_masks
+        self._masks = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the lock can't be pickled, a new one is made when unpickling
+        with self._lock:
+            return dict(self.__dict__, _masks=dict(), _lock=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def update(self, shapes_data, rasterize, find_labels):
+        """
+        Bring the cache up to date with shapes_data.
+        rasterize(view, slice, shapes) must return the mask for the shapes
+        drawn on that slice and find_labels(view, slice, mask) the set of labels
+        beneath that mask. Both are only called for slices whose shapes have
+        changed (or whose mask is missing, if keep_masks), so they must only
+        depend on their arguments.
+        Returns the list of (view, slice) pairs that changed.
+        """
+        dirty = []
+        with self._lock:
+            for view, view_shapes in enumerate(shapes_data):
+                for i, shapes in enumerate(view_shapes):
+                    key = (view, i)
+                    entry = self._entries.get(key)
+                    if len(shapes) == 0:
+                        if entry is not None:
+                            del self._entries[key]
+                            self._masks.pop(key, None)
+                            dirty.append(key)
+                        continue
+                    if entry is not None and entry[0] == shapes:
+                        if not self.keep_masks or key in self._masks:
+                            continue
+                        # the mask was not pickled, the labels are still right
+                        self._masks[key] = rasterize(view, i, shapes).copy()
+                        continue
+                    mask = rasterize(view, i, shapes)
+                    labels = frozenset(int(l) for l in find_labels(view, i, mask))
+                    self._entries[key] = (shapes, labels)
+                    if self.keep_masks:
+                        # the mask may be a view of a bigger array
+                        self._masks[key] = mask.copy()
+                    dirty.append(key)
+            # forget slices that are no longer in the shape data
+            for key in list(self._entries.keys()):
+                view, i = key
+                if view >= len(shapes_data) or i >= len(shapes_data[view]):
+                    del self._entries[key]
+                    self._masks.pop(key, None)
+                    dirty.append(key)
+        return dirty
+
+    def labels(self):
+        """ The union of the labels found beneath the masks of all the slices. """
+        with self._lock:
+            return set().union(*[labels for _, labels in self._entries.values()])
+
+    def masks(self):
+        """ Returns a list of ((view, slice), mask) for the slices with shapes,
+        which is only complete if keep_masks (and update was called since the
+        cache was unpickled). """
+        with self._lock:
+            return list(self._masks.items())
@@ -1,14 +1,182 @@
 #plotly_common/shape_utils.py
 
-from cairosvg import svg2png
-import skimage
-import PIL.Image
-import io
 import numpy as np
+import re
 
+# number of line segments a bezier curve is flattened into
+BEZIER_SEGMENTS = 16
 
-def shape_to_svg_code(shape, fig=None, width=None, height=None):
+_PATH_TOKEN = re.compile(r"[MLHVQCZmlhvqcz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+# number of coordinates taken by each path command
+_PATH_N_ARGS = dict(M=2, L=2, H=1, V=1, Q=4, C=6, Z=0)
+
+
+def _bezier_points(ctrl):
+    """
+    Returns BEZIER_SEGMENTS points along the bezier curve whose control points
+    (including the start point) are the rows of ctrl, excluding the start point.
+    """
+    t = np.linspace(0, 1, BEZIER_SEGMENTS + 1)[1:, None]
+    if len(ctrl) == 3:
+        p0, p1, p2 = ctrl
+        return (1 - t) ** 2 * p0 + 2 * (1 - t) * t * p1 + t ** 2 * p2
+    p0, p1, p2, p3 = ctrl
+    return (
+        (1 - t) ** 3 * p0
+        + 3 * (1 - t) ** 2 * t * p1
+        + 3 * (1 - t) * t ** 2 * p2
+        + t ** 3 * p3
+    )
+
+
+def path_to_polylines(path):
+    """
+    Parses an SVG path string like the "path" of a plotly path shape (commands
+    M, L, H, V, Q, C and Z and their relative versions) and returns a list of
+    (points, closed) tuples, one for each subpath, where points is a Nx2 array
+    of (x, y) coordinates. Curves are flattened into line segments.
+    """
+    tokens = _PATH_TOKEN.findall(path)
+    subpaths = []
+    points = []
+    cur = np.zeros(2)
+    start = np.zeros(2)
+    cmd = None
+    n = 0
+    while n < len(tokens):
+        if tokens[n].isalpha():
+            cmd = tokens[n]
+            n += 1
+        elif cmd is None:
+            raise ValueError("path must start with a command, got %s" % (path,))
+        upper = cmd.upper()
+        rel = cmd != upper
+        n_args = _PATH_N_ARGS[upper]
+        arg_tokens = tokens[n : n + n_args]
+        if len(arg_tokens) != n_args or any(a.isalpha() for a in arg_tokens):
+            raise ValueError("bad arguments for command %s in path %s" % (cmd, path))
+        args = np.array([float(a) for a in arg_tokens])
+        n += n_args
+        if upper == "M":
+            if len(points) > 1:
+                subpaths.append((np.array(points), False))
+            cur = args + cur if rel else args
+            start = cur
+            points = [cur]
+            # subsequent coordinate pairs are implicit lineto commands
+            cmd = "l" if rel else "L"
+        elif upper == "Z":
+            if len(points) > 1:
+                subpaths.append((np.array(points), True))
+            # drawing continues from the start of the closed subpath
+            cur = start
+            points = [cur]
+        elif upper in "LHV":
+            if upper == "L":
+                cur = args + cur if rel else args
+            elif upper == "H":
+                cur = np.array([args[0] + cur[0] if rel else args[0], cur[1]])
+            else:
+                cur = np.array([cur[0], args[0] + cur[1] if rel else args[0]])
+            points.append(cur)
+        else:
+            ctrl = args.reshape((-1, 2))
+            if rel:
+                ctrl = ctrl + cur
+            points.extend(_bezier_points(np.vstack((cur, ctrl))))
+            cur = ctrl[-1]
+        if n_args == 0 and n < len(tokens) and not tokens[n].isalpha():
+            raise ValueError("bad arguments for command %s in path %s" % (cmd, path))
+    if len(points) > 1:
+        subpaths.append((np.array(points), False))
+    return subpaths
+
+
+def _pixel_window(mask, xmin, xmax, ymin, ymax):
+    """
+    Returns the slices of mask containing the pixels that intersect the box
+    and the coordinates of those pixels' centres.
     """
+    h, w = mask.shape
+    c0, c1 = max(int(np.floor(xmin)), 0), min(int(np.ceil(xmax)), w)
+    r0, r1 = max(int(np.floor(ymin)), 0), min(int(np.ceil(ymax)), h)
+    if c0 >= c1 or r0 >= r1:
+        return None
+    cy, cx = np.mgrid[r0:r1, c0:c1] + 0.5
+    return ((slice(r0, r1), slice(c0, c1)), cx, cy)
+
+
+def _draw_segment(mask, p0, p1, half_width, value):
+    """
+    Sets to value the pixels of mask touched by the line from p0 to p1 stroked
+    with butt caps. A pixel is touched if any part of its square is covered,
+    which is what gives a non-zero value in an anti-aliased rendering.
+    """
+    d = p1 - p0
+    length = np.hypot(*d)
+    if length == 0:
+        return
+    t = d / length
+    nrm = np.array([-t[1], t[0]])
+    corners = np.array([p0 + nrm * half_width, p0 - nrm * half_width])
+    corners = np.vstack((corners, corners + d))
+    win = _pixel_window(
+        mask,
+        corners[:, 0].min(),
+        corners[:, 0].max(),
+        corners[:, 1].min(),
+        corners[:, 1].max(),
+    )
+    if win is None:
+        return
+    sl, cx, cy = win
+    px, py = cx - p0[0], cy - p0[1]
+    # half the extent of a pixel's square projected on the line's directions
+    pix = (abs(t[0]) + abs(t[1])) * 0.5
+    along = px * t[0] + py * t[1]
+    across = np.abs(px * nrm[0] + py * nrm[1])
+    touched = (along > -pix) & (along < length + pix) & (across < half_width + pix)
+    mask[sl][touched] = value
+
+
+def _draw_disc(mask, c, radius, value):
+    """ Sets to value the pixels of mask whose square intersects the disc. """
+    win = _pixel_window(
+        mask, c[0] - radius, c[0] + radius, c[1] - radius, c[1] + radius
+    )
+    if win is None:
+        return
+    sl, cx, cy = win
+    # distance from the disc centre to the closest point of each pixel
+    dx = np.maximum(np.abs(cx - c[0]) - 0.5, 0)
+    dy = np.maximum(np.abs(cy - c[1]) - 0.5, 0)
+    mask[sl][dx * dx + dy * dy < radius * radius] = value
+
+
+def draw_path(mask, path, stroke_width, value=1):
+    """
+    Strokes the SVG path string onto the 2D uint8 array mask (in place) with
+    the given stroke width, in the pixel coordinates of mask. Like the
+    renderings of the shapes by a browser, the path is not filled. Joins
+    between segments are drawn round, where an SVG renderer draws them mitred
+    by default, so the tips of sharp corners are left out.
+    """
+    half_width = stroke_width * 0.5
+    for points, closed in path_to_polylines(path):
+        if closed:
+            points = np.vstack((points, points[:1]))
+        for p0, p1 in zip(points[:-1], points[1:]):
+            _draw_segment(mask, p0, p1, half_width, value)
+        joins = points[1:] if closed else points[1:-1]
+        for p in joins:
+            _draw_disc(mask, p, half_width, value)
+    return mask
+
+
+def shape_to_mask(shape, fig=None, width=None, height=None):
+    """
+    Rasterizes the stroke of a plotly path shape into a uint8 array that is 1
+    where the stroke covers a pixel and 0 elsewhere.
     fig is the plotly.py figure which shape resides in (to get width and height)
     and shape is one of the shapes the figure contains.
     """
@@ -20,39 +188,8 @@ def shape_to_svg_code(shape, fig=None, width=None, height=None):
     else:
         if width is None or height is None:
             raise ValueError("If fig is None, you must specify width and height")
-    fmt_dict = dict(
-        width=width,
-        height=height,
-        stroke_color=shape["line"]["color"],
-        stroke_width=shape["line"]["width"],
-        path=shape["path"],
-    )
-    return """
-<svg
-    width="{width}"
-    height="{height}"
-    viewBox="0 0 {width} {height}"
->
-<path
-    stroke="{stroke_color}"
-    stroke-width="{stroke_width}"
-    d="{path}"
-    fill-opacity="0"
-/>
-</svg>
-""".format(
-        **fmt_dict
-    )
-
-
-def shape_to_png(fig=None, shape=None, width=None, height=None, write_to=None):
-    """
-    Like svg2png, if write_to is None, returns a bytestring. If it is a path
-    to a file it writes to this file and returns None.
-    """
-    svg_code = shape_to_svg_code(fig=fig, shape=shape, width=width, height=height)
-    r = svg2png(bytestring=svg_code, write_to=write_to)
-    return r
+    mask = np.zeros((int(height), int(width)), dtype=np.uint8)
+    return draw_path(mask, shape["path"], shape["line"]["width"])
 
 
 def shapes_to_mask(shape_args, shape_layers):
@@ -61,32 +198,24 @@ def shapes_to_mask(shape_args, shape_layers):
     of all shapes's bounding boxes and number of columns equal to their number
     of rows.
     shape_args is a list of dictionaries whose keys are the parameters to the
-    shape_to_png function.
-    The mask is taken to be all the pixels that are non-zero in the resulting
-    image from rendering the shape.
+    shape_to_mask function.
+    The mask is taken to be all the pixels that are covered by the rendered
+    shape.
     shape_layers is either a number or an array
     if a number, all the layers have the same number in the mask
     if an array, must be the same length as shape_args and each entry is an
     integer in [0...255] specifying the layer number. Note that the convention
     is that 0 means no mask, so generally the layer numbers will be non-zero.
     """
-    images = []
-    for sa in shape_args:
-        pngbytes = shape_to_png(**sa)
-        images.append(PIL.Image.open(io.BytesIO(pngbytes)))
-
-    mwidth, mheight = [max([im.size[i] for im in images]) for i in range(2)]
+    imarys = [shape_to_mask(**sa) for sa in shape_args]
+    mheight, mwidth = [max([im.shape[i] for im in imarys]) for i in range(2)]
     mask = np.zeros((mheight, mwidth), dtype=np.uint8)
     if type(shape_layers) != type(list()):
         layer_numbers = [shape_layers for _ in shape_args]
     else:
         layer_numbers = shape_layers
-    imarys = []
-    for layer_num, im in zip(layer_numbers, images):
+    for layer_num, imary in zip(layer_numbers, imarys):
         # layer 0 is reserved for no mask
-        imary = skimage.util.img_as_ubyte(np.array(im))
-        imary = np.sum(imary, axis=2)
-        imary.resize((mheight, mwidth))
-        imarys.append(imary)
-        mask[imary != 0] = layer_num
+        h, w = imary.shape
+        mask[:h, :w][imary != 0] = layer_num
     return mask
@@ -0,0 +1,102 @@
+#plotly_common/slic_utils.py
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from skimage import segmentation
+
+
+def _slic_slab(args):
+    slab, slic_kwargs = args
+    return segmentation.slic(slab, start_label=1, **slic_kwargs)
+
+
+def _find(parent, a):
+    while parent[a] != a:
+        parent[a] = parent[parent[a]]
+        a = parent[a]
+    return a
+
+
+def _merge_overlap(parent, la, lb, min_overlap):
+    """
+    la and lb are the labels given to the same voxels by two slabs. Merges
+    (in the union-find forest parent) the pairs of labels that are each
+    other's best match and share at least min_overlap of the voxels of the
+    smaller of the two in the overlap.
+    """
+    la, lb = la.ravel(), lb.ravel()
+    pairs, counts = np.unique(np.stack((la, lb)), axis=1, return_counts=True)
+    size_a = dict(zip(*np.unique(la, return_counts=True)))
+    size_b = dict(zip(*np.unique(lb, return_counts=True)))
+    best_a, best_b = dict(), dict()
+    for (a, b), c in zip(pairs.T, counts):
+        if c > best_a.get(a, (None, 0))[1]:
+            best_a[a] = (b, c)
+        if c > best_b.get(b, (None, 0))[1]:
+            best_b[b] = (a, c)
+    for a, (b, c) in best_a.items():
+        if best_b[b][0] == a and c >= min_overlap * min(size_a[a], size_b[b]):
+            parent[_find(parent, b)] = _find(parent, a)
+
+
+def chunked_slic(
+    img, n_segments, n_chunks, overlap=8, min_overlap=0.5, max_workers=None, **kwargs
+):
+    """
+    Partitions the volume img into about n_segments superpixels with SLIC, like
+    skimage.segmentation.slic(img, n_segments=n_segments, start_label=1,
+    **kwargs), but running SLIC on n_chunks slabs along the first axis in
+    parallel processes.
+    Neighbouring slabs overlap by overlap slices on each side of their boundary.
+    Each voxel takes the label given by the slab whose core (the slab without
+    the overlap) contains it, and the labels of neighbouring slabs that match
+    in the overlap (see min_overlap) are merged, so that superpixels crossing a
+    boundary get a single label. The labels are consecutive, starting from 1.
+    Processes are forked, so on platforms where that is not possible the slabs
+    are partitioned one after the other.
+    """
+    n = img.shape[0]
+    n_chunks = max(1, min(n_chunks, n))
+    bounds = np.linspace(0, n, n_chunks + 1).round().astype(int)
+    slabs = [
+        (max(0, b0 - overlap), min(n, b1 + overlap))
+        for b0, b1 in zip(bounds[:-1], bounds[1:])
+    ]
+    args = [
+        (
+            img[s0:s1],
+            dict(kwargs, n_segments=max(1, int(round(n_segments * (s1 - s0) / n)))),
+        )
+        for s0, s1 in slabs
+    ]
+    if n_chunks > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            slab_labels = list(executor.map(_slic_slab, args))
+    else:
+        slab_labels = [_slic_slab(a) for a in args]
+    # make the labels of the slabs distinct
+    offset = 0
+    for labels in slab_labels:
+        labels += offset
+        offset = labels.max()
+    parent = np.arange(offset + 1)
+    for k in range(n_chunks - 1):
+        (a0, a1), (b0, b1) = slabs[k], slabs[k + 1]
+        # the slices computed by both slabs
+        _merge_overlap(
+            parent,
+            slab_labels[k][b0 - a0 : a1 - a0],
+            slab_labels[k + 1][: a1 - b0],
+            min_overlap,
+        )
+    roots = np.array([_find(parent, l) for l in range(offset + 1)])
+    seg = np.empty(img.shape, dtype=slab_labels[0].dtype)
+    for (b0, b1), (s0, _), labels in zip(
+        zip(bounds[:-1], bounds[1:]), slabs, slab_labels
+    ):
+        seg[b0:b1] = roots[labels[b0 - s0 : b1 - s0]]
+    seg, _, _ = segmentation.relabel_sequential(seg)
+    return seg
@@ -0,0 +1,92 @@
+#plotly_common/slice_cache.py
+
+import hashlib
+import os
+import threading
+import numpy as np
+from plotly_common.array_cache import write_atomically
+from plotly_common.lru import LRUCache
+from plotly_common.plot_common import array_to_png_bytes, png_bytes_to_uri
+
+
+class SliceCache:
+    """
+    Serves the slices of named volumes encoded as PNG. A slice is only encoded
+    the first time it is requested and the maxsize most recently requested
+    encoded slices are kept, so memory does not grow with the size of the
+    volumes and nothing is encoded before it is needed.
+    The slices of view v of a volume are the subarrays obtained by indexing
+    its axis v, i.e., view 0 gives volume[i,:,:] and view 1 volume[:,i,:].
+    Extra (hashable) arguments can be given when requesting a slice, these are
+    passed on to the volume's encode function and are part of the cache key, so
+    one volume can give many renderings of its slices.
+    Each encoded slice comes with an ETag derived from its contents.
+    A volume can also be given a directory where its encoded slices (those
+    requested without extra arguments) are written, so that they are read
+    back instead of encoded again by later processes.
+    """
+
+    def __init__(self, maxsize=1024):
+        # name -> (volume, encode, cache_dir)
+        self._volumes = dict()
+        # (name, view, index, *args) -> (PNG bytes, ETag)
+        self._encoded = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def add_volume(self, name, volume, encode=array_to_png_bytes, cache_dir=None):
+        """
+        Make the slices of volume available under name. encode is called on a
+        slice (followed by the extra arguments the slice was requested with)
+        and must return the bytes of the encoded image.
+        If cache_dir is given, the encoded slices are also stored there. It
+        must only ever be used for this volume encoded this way (e.g. its name
+        should be derived from the contents of the volume).
+        If a volume of that name was already added, it is replaced.
+        """
+        with self._lock:
+            self._volumes[name] = (volume, encode, cache_dir)
+            for key in self._encoded.keys():
+                if key[0] == name:
+                    self._encoded.pop(key)
+
+    def n_slices(self, name, view):
+        return self._volumes[name][0].shape[view]
+
+    def get_slice(self, name, view, index):
+        """
+        Returns the array of a slice. Raises KeyError if there is no volume
+        called name and IndexError if the view or index are out of range.
+        """
+        volume = self._volumes[name][0]
+        if not (0 <= view < volume.ndim and 0 <= index < volume.shape[view]):
+            raise IndexError("no slice %d in view %d of %s" % (index, view, name))
+        return np.take(volume, index, axis=view)
+
+    def get(self, name, view, index, *args):
+        """ Returns the bytes of the slice encoded as PNG and their ETag. """
+        key = (name, view, index) + args
+        entry = self._encoded.get(key)
+        if entry is None:
+            _, encode, cache_dir = self._volumes[name]
+            path = None
+            if cache_dir is not None and len(args) == 0:
+                path = os.path.join(cache_dir, "%d-%d.png" % (view, index))
+            if path is not None and os.path.exists(path):
+                with open(path, "rb") as fp:
+                    png = fp.read()
+            else:
+                png = encode(self.get_slice(name, view, index), *args)
+                if path is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    write_atomically(path, lambda fp: fp.write(png))
+            entry = (png, hashlib.sha1(png).hexdigest())
+            self._encoded.put(key, entry)
+        return entry
+
+    def png(self, name, view, index, *args):
+        """ Returns the bytes of the slice encoded as PNG. """
+        return self.get(name, view, index, *args)[0]
+
+    def data_url(self, name, view, index, *args):
+        """ Returns the slice encoded as a PNG data URL. """
+        return png_bytes_to_uri(self.png(name, view, index, *args))
@@ -0,0 +1,81 @@
+#plotly_common/slice_labels.py
+
+import numpy as np
+from scipy import ndimage
+from plotly_common.lru import LRUCache
+
+
+class SliceLabels:
+    """
+    Records which labels of a label tensor appear in each slice of each of the
+    views (the slices of view v are the subarrays obtained by indexing axis v),
+    so that the slices containing a selection of labels are found without
+    touching the tensor.
+    The binary masks of the labels in a slice, cropped to each label's
+    bounding box in the slice, are made the first time the slice is drawn and
+    kept for the maxsize most recently drawn slices, so the mask of a
+    selection on a slice is composed from the masks of the selected labels it
+    contains instead of comparing every voxel of the slice to the selection.
+    Labels must be non-negative integers.
+    """
+
+    def __init__(self, labels, n_labels=None, views=(0, 1), maxsize=1024):
+        self.labels = labels
+        self.n_labels = int(labels.max()) + 1 if n_labels is None else n_labels
+        # view -> boolean array, presence[view][i, l] is true if label l
+        # appears in slice i
+        self.presence = dict()
+        for view in views:
+            presence = np.zeros((labels.shape[view], self.n_labels), dtype=bool)
+            for i in range(labels.shape[view]):
+                presence[i][np.take(labels, i, axis=view).ravel()] = True
+            self.presence[view] = presence
+        # (view, index) -> {label: (box, mask of the label in the box)}
+        self._masks = LRUCache(maxsize)
+
+    def slice_labels(self, view, index):
+        """ Returns the labels appearing in a slice, as a sorted array. """
+        return np.flatnonzero(self.presence[view][index])
+
+    def selected_slices(self, view, selected):
+        """
+        Returns a dict mapping the index of each slice of view containing labels
+        for which selected (a boolean array over the labels, like
+        LabelSet.mask) is true to the sorted list of those labels it contains.
+        """
+        hits = self.presence[view] & selected
+        return {
+            int(i): np.flatnonzero(hits[i]).tolist()
+            for i in np.flatnonzero(hits.any(axis=1))
+        }
+
+    def label_masks(self, view, index):
+        """ Returns a dict mapping each label of a slice to the (box, mask) of
+        its voxels in the slice, where box is a tuple of slices. """
+        key = (view, index)
+        masks = self._masks.get(key)
+        if masks is None:
+            s = np.take(self.labels, index, axis=view)
+            masks = dict()
+            # find_objects gives the box of label l at l-1, the box of label 0
+            # is taken to be the slice
+            boxes = [tuple(slice(0, n) for n in s.shape)] + ndimage.find_objects(s)
+            for l in self.slice_labels(view, index):
+                box = boxes[l] if l < len(boxes) else None
+                if box is not None:
+                    masks[int(l)] = (box, s[box] == l)
+            self._masks.put(key, masks)
+        return masks
+
+    def compose(self, view, index, labels, value=1, dtype="uint8"):
+        """ Returns the mask of a slice that is value where the label is in
+        labels and 0 elsewhere, made from the masks of the labels. """
+        shape = [n for a, n in enumerate(self.labels.shape) if a != view]
+        out = np.zeros(shape, dtype=dtype)
+        masks = self.label_masks(view, index)
+        for l in labels:
+            entry = masks.get(int(l))
+            if entry is not None:
+                box, mask = entry
+                out[box][mask] = value
+        return out
@@ -0,0 +1,63 @@
+#plotly_common/superpixel_stats.py
+
+import numpy as np
+from scipy import ndimage
+
+# the number of voxels accumulated at a time, so that the intensities are never
+# converted to floating point all at once
+STATS_CHUNK_SIZE = 1 << 22
+
+
+class SuperpixelStats:
+    """
+    Statistics of the intensities of img over each label of the label tensor
+    labels (of the same shape): the number of voxels (count), the mean and
+    standard deviation of the intensities (mean, std) and the bounding box of
+    the voxels (start, stop), all arrays indexed by label.
+    They are computed with bincount over the integer labels in chunks, in a
+    single pass over the volume, plus one pass to find the bounding boxes.
+    Labels must be non-negative integers. Labels without voxels have a count,
+    mean and std of 0 and an empty box. The box of label 0 (the background)
+    is the whole tensor.
+    """
+
+    def __init__(self, labels, img, n_labels=None):
+        flat = labels.ravel()
+        values = img.ravel()
+        n = max(int(flat.max()) + 1 if flat.size > 0 else 1, n_labels or 0)
+        self.count = np.zeros(n, dtype=np.int64)
+        sums = np.zeros(n)
+        squares = np.zeros(n)
+        for b in range(0, flat.size, STATS_CHUNK_SIZE):
+            l = flat[b : b + STATS_CHUNK_SIZE]
+            v = values[b : b + STATS_CHUNK_SIZE].astype(np.float64)
+            self.count += np.bincount(l, minlength=n)
+            sums += np.bincount(l, weights=v, minlength=n)
+            squares += np.bincount(l, weights=v * v, minlength=n)
+        present = self.count > 0
+        self.mean = np.zeros(n)
+        self.mean[present] = sums[present] / self.count[present]
+        self.std = np.zeros(n)
+        self.std[present] = np.sqrt(
+            np.maximum(
+                squares[present] / self.count[present] - self.mean[present] ** 2, 0
+            )
+        )
+        self.start = np.zeros((n, labels.ndim), dtype=np.int64)
+        self.stop = np.zeros((n, labels.ndim), dtype=np.int64)
+        self.stop[0] = labels.shape
+        for l, box in enumerate(ndimage.find_objects(labels), start=1):
+            if box is not None:
+                self.start[l] = [s.start for s in box]
+                self.stop[l] = [s.stop for s in box]
+
+    @property
+    def n_labels(self):
+        """ The number of label slots (the greatest label + 1). """
+        return len(self.count)
+
+    def bbox(self, label):
+        """ The bounding box of the label's voxels, as a tuple of slices. """
+        return tuple(
+            slice(int(b), int(e)) for b, e in zip(self.start[label], self.stop[label])
+        )
@@ -1,4 +1,14 @@
+# The app is imported once in the master process (--preload), so the default
+# case is loaded before the workers are forked and they share its pages. The
+# cached arrays are memory-mapped read-only .npy files, so the cases loaded
+# later by the workers are shared through the page cache as well.
+# The number of workers is read by gunicorn from WEB_CONCURRENCY.
+# The workers share the annotation sessions through SESSION_DIR (by default
+# cache/sessions), which must not be set to "" when there are several.
+# The sessions not stored for SESSION_MAX_AGE seconds (by default a day) are
+# removed from it.
 gunicorn \
 --pythonpath plotly-common \
+--preload \
 -e LOAD_SUPERPIXEL=assets/BraTS19_2013_10_1_flair_superpixels.npz.gz \
 app:server